@@ -0,0 +1,11 @@
+import os
+from functools import lru_cache
+from dotenv import load_dotenv, find_dotenv
+
+@lru_cache(maxsize=1)
+def load():
+    """
+    Load .env once per process: the nearest one from the working directory up,
+    else the one next to these scripts (the repo root).
+    """
+    load_dotenv(find_dotenv(usecwd=True) or os.path.join(os.path.dirname(os.path.abspath(__file__)), ".env"))
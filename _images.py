@@ -0,0 +1,15 @@
+import os
+
+def index_images(directory):
+    """
+    {id: path} for the .jpg / .png files in `directory`, from a single scandir pass
+    (.jpg wins when both exist).
+    """
+    index = {}
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            stem, ext = os.path.splitext(entry.name)
+            ext = ext.lower()
+            if ext == ".jpg" or (ext == ".png" and stem not in index):
+                index[stem] = entry.path
+    return index
@@ -1,11 +1,411 @@
 import os
+import atexit
 import json
+import asyncio
 import time
-import random
 import io
+import re
+import base64
+import hashlib
+import itertools
+import functools
+import tempfile
+import threading
+import multiprocessing
+from collections import OrderedDict
 from typing import Dict, Optional, List
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed, TimeoutError as FuturesTimeout
 import traceback
 
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+from PIL import Image, ImageDraw, ImageFont, ImageOps
+
+# pillow-simd reports versions like "9.5.0.post1"; log it once so a fallback to stock Pillow is visible
+print(f"[AI] Pillow {Image.__version__}")
+
+# OpenCV (optional): SIMD resize kernels that release the GIL; PIL is the fallback
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+# libjpeg-turbo via PyTurboJPEG (optional): SIMD Huffman coding, faster than PIL's encoder
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB, TJSAMP_420
+    _TJ = TurboJPEG()
+except Exception:
+    _TJ = None
+
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+# aiohttp (optional): async download of try-on results in virtual_try_on_async
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+# Strips ```json ... ``` fences Gemini sometimes wraps around its JSON
+_FENCE = re.compile(r"^```(?:json)?\s*|\s*```$", re.S)
+
+# Encode settings for result JPEGs on the hot path.
+# optimize/progressive add extra passes over the data for a few % of size;
+# quality 85 is visually indistinguishable from 95 at these resolutions.
+JPEG_ENCODE_OPTIONS = {"quality": 85, "subsampling": 2, "optimize": False, "progressive": False}
+# WebP is ~2-4x smaller than JPEG at equal quality; offered to clients that accept it.
+WEBP_ENCODE_OPTIONS = {"quality": 85, "method": 4}
+# Results within this many pixels of the original size are returned without resizing
+RESIZE_TOLERANCE = 4
+
+# Free Spaces often 503 for minutes at a time: after GRADIO_FAIL_THRESHOLD failures
+# within GRADIO_FAIL_WINDOW seconds, skip Gradio for GRADIO_COOLDOWN seconds.
+GRADIO_FAIL_THRESHOLD = 3
+GRADIO_FAIL_WINDOW = 300
+GRADIO_COOLDOWN = 300
+
+# TRYON_RACE=1: run Replicate and Gradio concurrently instead of Gradio only after Replicate fails
+TRYON_RACE = os.getenv("TRYON_RACE") == "1"
+TRYON_RACE_TIMEOUT = 55
+
+# Prepared (trimmed + standardized) garment canvases, keyed by content hash
+CLOTH_ASSET_DIR = os.path.join(tempfile.gettempdir(), "cloth_assets")
+
+# Per-key Gemini budget (free tier is ~15 requests/min); callers wait at most
+# GEMINI_WAIT_TIMEOUT seconds for a token before giving up.
+GEMINI_RATE_PER_MIN = float(os.getenv("GEMINI_RATE_PER_MIN", "15"))
+GEMINI_BURST = 5
+GEMINI_WAIT_TIMEOUT = 10.0
+# A key that returned 429 / quota exhausted is skipped for this long
+GEMINI_KEY_COOLDOWN = 60
+# (key, model) combinations tried concurrently; the first success wins
+GEMINI_PARALLEL_ATTEMPTS = int(os.getenv("GEMINI_PARALLEL_ATTEMPTS", "3"))
+# Only the semantic fields are used; body landmarks were for the removed overlay path
+STYLE_PROMPT = """
+        請分析這張衣服或穿搭照片。
+        請回傳一個 JSON 物件，包含以下欄位：
+        1. "name": 適合這張圖片中衣著的簡短名稱。
+        2. "style": 風格 (例如：休閒、正式)。
+        
+        請直接回傳 JSON，不要 markdown 格式。
+        """
+
+# Watermark fonts in order of preference: Chinese (Windows, then Linux/Noto); arial as last resort
+WATERMARK_FONTS = [
+    "C:/Windows/Fonts/msjh.ttc",
+    "/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/noto-cjk/NotoSansCJK-Regular.ttc",
+]
+
+# Per-model success/failure counters, kept across restarts to order the rotation
+GEMINI_STATS_PATH = os.path.join(tempfile.gettempdir(), "gemini_stats.json")
+# Counters are updated in memory per attempt and written at most this often (s), off the event loop
+GEMINI_STATS_SAVE_INTERVAL = 30.0
+
+# Gemini results (style / validation) keyed by sha256 of the image: in-memory LRU + JSON on disk
+GEMINI_CACHE_DIR = os.path.join(tempfile.gettempdir(), "gemini_cache")
+GEMINI_CACHE_SIZE = 256
+# Rendered watermark strips kept per (width, height, text); results come in a handful of sizes
+WATERMARK_CACHE_SIZE = 8
+# Threads for the local PIL stages (garment prep, resize / watermark / encode), kept apart
+# from the I/O threads that wait on remote models; 1 serializes them per process
+AI_CPU_WORKERS = int(os.getenv("AI_CPU_WORKERS", "1"))
+# OOTDiffusion outputs keyed by sha256(person) + sha256(cloth) + category
+TRYON_CACHE_DIR = os.path.join(tempfile.gettempdir(), "tryon_cache")
+
+# Gemini Batch Mode (half price, results within 24h) for offline wardrobe analysis
+GEMINI_BATCH_MODEL = "gemini-2.5-flash"
+GEMINI_BATCH_POLL = 30
+
+# Gemini bills images per 768px tile; a 1024px long side is plenty for style/validation
+GEMINI_IMAGE_MAX_SIDE = 1024
+
+def _gemini_image_part(img_bytes: bytes) -> dict:
+    """
+    Build the Gemini inline image part, downscaling large photos first so each
+    request uploads (and is billed for) fewer bytes/tiles.
+    """
+    try:
+        with Image.open(io.BytesIO(img_bytes)) as img:
+            if max(img.size) > GEMINI_IMAGE_MAX_SIDE:
+                img.draft("RGB", (GEMINI_IMAGE_MAX_SIDE, GEMINI_IMAGE_MAX_SIDE))
+                img = ImageOps.exif_transpose(img).convert("RGB")
+                img.thumbnail((GEMINI_IMAGE_MAX_SIDE, GEMINI_IMAGE_MAX_SIDE))
+                img_bytes = _encode_image(img)
+    except Exception as e:
+        print(f"Gemini image downscale skipped: {e}")
+    return {"mime_type": "image/jpeg", "data": img_bytes}
+
+class TokenBucket:
+    """
+    In-process token bucket. Rate adapts AIMD-style: halved on 429, slowly restored on success.
+    (Per process only - with several uvicorn workers each one keeps its own budget.)
+    """
+    def __init__(self, rate_per_min: float, burst: int):
+        self.max_rate = rate_per_min / 60.0
+        self.min_rate = self.max_rate / 8
+        self.rate = self.max_rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self) -> bool:
+        with self._lock:
+            self._refill(time.monotonic())
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+    def wait_time(self) -> float:
+        """
+        Seconds until the next token is available.
+        """
+        with self._lock:
+            self._refill(time.monotonic())
+            return max(0.0, (1 - self.tokens) / self.rate)
+
+    def on_rate_limited(self):
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+
+    def on_success(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+
+def _parse_gemini_json(text: str):
+    """
+    Parse a Gemini JSON answer: strip ``` fences and any chatter around the outer {...}.
+    """
+    text = _FENCE.sub("", text.strip()).strip()
+    if not text.startswith("{"):
+        # Find first { and last }
+        start = text.find("{")
+        end = text.rfind("}") + 1
+        if start != -1 and end != 0:
+            text = text[start:end]
+    return _json_loads(text)
+
+def _encode_image(img, fmt: str = "JPEG") -> bytes:
+    """
+    Encode a result image as JPEG (default) or WEBP.
+    """
+    if fmt != "WEBP" and _TJ is not None and img.mode == "RGB":
+        return _TJ.encode(np.asarray(img), quality=JPEG_ENCODE_OPTIONS["quality"],
+                          pixel_format=TJPF_RGB, jpeg_subsample=TJSAMP_420)
+
+    out = io.BytesIO()
+    if fmt == "WEBP":
+        img.save(out, format="WEBP", **WEBP_ENCODE_OPTIONS)
+    else:
+        img.save(out, format="JPEG", **JPEG_ENCODE_OPTIONS)
+    return out.getvalue()
+
+def _resize_image(img, size, resample=Image.Resampling.LANCZOS, reducing_gap=None):
+    """
+    Resize an RGB image, using OpenCV when installed and PIL otherwise.
+    reducing_gap box-reduces large downsamples before the main filter.
+    """
+    if cv2 is None or img.mode != "RGB":
+        return img.resize(size, resample, reducing_gap=reducing_gap)
+    if reducing_gap:
+        # Same idea for OpenCV: BOX-reduce by an integer factor while the rest of the
+        # downsample stays >= reducing_gap, so Lanczos runs on a much smaller image
+        factor = int(min(img.width / size[0], img.height / size[1]) / reducing_gap)
+        if factor >= 2:
+            img = img.reduce(factor)
+    interpolation = cv2.INTER_CUBIC if resample == Image.Resampling.BICUBIC else cv2.INTER_LANCZOS4
+    # Same channel order in and out, so no RGB<->BGR swap is needed
+    arr = cv2.resize(np.asarray(img), size, interpolation=interpolation)
+    return Image.fromarray(arr, "RGB")
+
+def _replicate_category(category: str) -> str:
+    """
+    Map a clothing category to idm-vton's "upper_body" / "lower_body" / "dresses".
+    """
+    # Map Frontend Categories to Replicate "upper_body", "lower_body", "dresses"
+    cat_map = {
+        "upper-body": "upper_body",
+        "lower-body": "lower_body",
+        "dresses": "dresses",
+        # New Fine-grained Lower Body mappings
+        "mini skirt": "lower_body",
+        "midi skirt": "lower_body",
+        "long skirt": "lower_body",
+        "maxi skirt": "lower_body",
+        "hot pants": "lower_body",
+        "capri pants": "lower_body",
+        "ankle pants": "lower_body",
+        "trousers": "lower_body"
+    }
+    # Default to upper_body if not found (or if already correct format)
+    api_category = cat_map.get(category.lower(), "upper_body")
+    
+    # Double check validity
+    if api_category not in ["upper_body", "lower_body", "dresses"]:
+        api_category = "upper_body"
+    return api_category
+
+def _trim(im):
+    """
+    Crop away the uniform border (same color as the top-left pixel) around a garment.
+    """
+    arr = np.asarray(im)
+    if arr.ndim == 2:
+        arr = arr[..., None]
+    # Foreground = any channel more than 100 away from the corner color
+    mask = np.any(np.abs(arr.astype(np.int16) - arr[0, 0]) > 100, axis=2)
+    rows = np.flatnonzero(mask.any(axis=1))
+    if rows.size:
+        cols = np.flatnonzero(mask.any(axis=0))
+        return im.crop((int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1))
+    return im
+
+def _ootd_category(cloth_name: str, category: Optional[str]) -> str:
+    """
+    Map a clothing category (or, if missing, the cloth name) to an OOTD category.
+    """
+    # Determine category
+    if not category:
+        if "裙" in cloth_name or "洋裝" in cloth_name:
+            category = "Dress"
+        elif "褲" in cloth_name:
+            category = "Lower-body"
+        else:
+            category = "Upper-body"
+
+    # Map to OOTD strings
+    ootd_category = "Upper-body"
+    if category.lower() in ["lower-body", "lower_body", "bottom"]:
+        ootd_category = "Lower-body"
+    elif category.lower() in ["dress", "dresses", "whole-body", "whole_body"]:
+        ootd_category = "Dress"
+    return ootd_category
+
+def _standardize_garment(cloth_bytes: bytes, ootd_category: str):
+    """
+    Trim a garment photo and fit it onto a white 768x1024 OOTDiffusion canvas.
+    """
+    canvas_w, canvas_h = 768, 1024
+
+    with Image.open(io.BytesIO(cloth_bytes)) as src:
+        # JPEG: let libjpeg IDCT at 1/2, 1/4... scale while staying >= canvas size
+        src.draft("RGB", (canvas_w, canvas_h))
+        raw_c_img = src.convert("RGB")
+
+    # 1. Trim (Remove borders)
+    c_img_trimmed = _trim(raw_c_img)
+    
+    # 2. Standardize for VTON (768x1024 Canvas)
+    # This ensures OOTD receives a high-quality, centered input regardless of original crop.
+    # Fit garment into canvas
+    # Adjust coverage based on category
+    target_coverage_w = 0.9
+    target_coverage_h = 0.9
+    
+    c_w, c_h = c_img_trimmed.size
+    
+    if ootd_category == "Lower-body":
+         # PANTS FIX (Texture Preservation):
+         # Problem: Stretching distorted the texture (e.g. Plaid), creating weird artifacts.
+         # Problem: Wide inputs became shorts.
+         # Solution: CROP the sides of the input garment to force a "Tall" aspect ratio WITHOUT stretching.
+         
+         # 1. Check Aspect Ratio
+         c_aspect = c_w / c_h
+         target_aspect = 0.55 # Target: Slim Tall Pants
+         
+         if c_aspect > target_aspect:
+             # Too Wide!
+             # Calculate new width to match target aspect ratio based on height
+             new_source_w = int(c_h * target_aspect)
+             
+             # Center Crop
+             left = (c_w - new_source_w) // 2
+             right = left + new_source_w
+             print(f"Pants too wide ({c_aspect:.2f}). Cropping width from {c_w} to {new_source_w} to force Long Pants...")
+             
+             c_img_trimmed = c_img_trimmed.crop((left, 0, right, c_h))
+             c_w, c_h = c_img_trimmed.size # Update dimensions
+         
+         # 2. Scale to Canvas
+         # Now proper aspect ratio is guaranteed. Scale to Height.
+         target_h = int(canvas_h * 0.92) # 92% Height (Ankle)
+         
+         scale = target_h / c_h
+         new_w = int(c_w * scale)
+         new_h = target_h
+         
+         # Cap width if it exceeds canvas (unlikely after crop, but good for safety)
+         if new_w > int(canvas_w * 0.9):
+              scale = (canvas_w * 0.9) / c_w
+              new_w = int(c_w * scale)
+              new_h = int(c_h * scale)
+
+         c_img_resized = _resize_image(c_img_trimmed, (new_w, new_h), Image.Resampling.BICUBIC)
+         
+         # 3. Position (Centered-ish)
+         # Shift slightly down to ensure waist isn't too high
+         paste_x = (canvas_w - new_w) // 2
+         paste_y = canvas_h - new_h # Flush Bottom
+         
+    else:
+         # Standard logic for Check/Upper/Dress (Centered)
+         scale = min((canvas_w * target_coverage_w) / c_w, (canvas_h * target_coverage_h) / c_h)
+         new_w = int(c_w * scale)
+         new_h = int(c_h * scale)
+         c_img_resized = _resize_image(c_img_trimmed, (new_w, new_h), Image.Resampling.BICUBIC)
+         
+         paste_x = (canvas_w - new_w) // 2
+         paste_y = (canvas_h - new_h) // 2
+    
+    # Paste on White Canvas (one memset + one slice copy)
+    canvas = np.full((canvas_h, canvas_w, 3), 255, np.uint8)
+    canvas[paste_y:paste_y + new_h, paste_x:paste_x + new_w] = np.asarray(c_img_resized)
+    final_cloth = Image.fromarray(canvas, "RGB")
+    
+    if ootd_category == "Lower-body":
+         print(f"Pants Layout: SIDE-CROP - Size {c_img_resized.size}")
+
+    return final_cloth
+
+def _write_garment_asset(cloth_bytes: bytes, ootd_category: str, path: str):
+    """
+    _standardize_garment + save, as one picklable call for the garment process pool.
+    """
+    _standardize_garment(cloth_bytes, ootd_category).save(path, format="JPEG", quality=95)
+
+# Garment prep can run in worker processes (true parallelism for the PIL / NumPy work,
+# no GIL contention with request handling). Opt-in, since each web worker gets its own
+# pool: 0 (the default, and the only option on serverless) keeps it in the calling thread.
+AI_PROCESS_WORKERS = int(os.getenv("AI_PROCESS_WORKERS", "0"))
+_PROC_POOL = None
+_PROC_POOL_LOCK = threading.Lock()
+
+def _garment_pool():
+    """
+    Process pool for _write_garment_asset, started on first use (None when disabled).
+    forkserver children don't inherit this process's threads and locks.
+    """
+    global _PROC_POOL
+    if AI_PROCESS_WORKERS <= 0:
+        return None
+    with _PROC_POOL_LOCK:
+        if _PROC_POOL is None:
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            _PROC_POOL = ProcessPoolExecutor(max_workers=AI_PROCESS_WORKERS,
+                                             mp_context=multiprocessing.get_context(method))
+        return _PROC_POOL
+
 class AIService:
     def __init__(self):
         # Gemini Setup
@@ -16,9 +416,8 @@ class AIService:
         keys_1 = (os.getenv("GEMINI_API_KEY", "")).split(',')
         keys_2 = (os.getenv("GOOGLE_API_KEY", "")).split(',')
         
-        # Combine and deduplicate
-        all_keys = [k.strip() for k in keys_1 + keys_2 if k.strip()]
-        self.gemini_keys = list(set(all_keys))
+        # Combine and deduplicate (order-preserving, so key order is stable across restarts)
+        self.gemini_keys = list(dict.fromkeys(k.strip() for k in keys_1 + keys_2 if k.strip()))
         
         self.gemini_models = [
             'gemini-3-flash',          # High performance (2026 verified)
@@ -28,8 +427,53 @@ class AIService:
             'gemini-1.5-pro',          # Legacy fallback
         ]
         
+        # Watermark font: resolved once, parsed once per size (see _get_font)
+        self._font_path = next((p for p in WATERMARK_FONTS if os.path.exists(p)), "arial.ttf")
+        self._font_cache = {}
+        self._wm_overlay_cache = OrderedDict()
+        self._wm_lock = threading.Lock()
+
+        # Gemini result cache (see _cache_get / _cache_put)
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+
+        # One rate limiter per key, plus quota cooldowns and models that 404 for a key
+        self._buckets = {k: TokenBucket(GEMINI_RATE_PER_MIN, GEMINI_BURST) for k in self.gemini_keys}
+        self._key_cooldown = {}
+        self._dead_models = set()
+        self._key_cycle = itertools.cycle(range(len(self.gemini_keys)))
+        self._key_lock = threading.Lock()
+        self._models = {}
+
+        # {model: [successes, failures, last_success_ts]} (see _ranked_models)
+        self._model_stats = self._load_model_stats()
+        self._stats_saved_at = time.monotonic()
+        self._stats_dirty = False
+        # One writer thread: saves happen in order and never on the event loop
+        self._stats_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="gemini-stats")
+        atexit.register(self._flush_model_stats)
+
         # Replicate Setup
         self.replicate_token = os.getenv("REPLICATE_API_TOKEN")
+        # Pooled keep-alive HTTP session for downloading results (skips a TLS handshake per try-on)
+        self._http = requests.Session()
+        self._http.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+        # aiohttp session for virtual_try_on_async, created on first use inside the event loop
+        self._aio = None
+        # Dedicated pool for the PIL work (see run_cpu)
+        self._cpu_pool = ThreadPoolExecutor(max_workers=AI_CPU_WORKERS, thread_name_prefix="ai")
+
+        # SDK modules, imported once in the background (see _preload_modules)
+        self.genai = None
+        self.replicate = None
+        self.gradio_client = None
+        self._modules_ready = threading.Event()
+        threading.Thread(target=self._preload_modules, daemon=True).start()
+
+        # Gradio Space health (consecutive failures, first failure ts, skip deadline)
+        self._gradio_fail_count = 0
+        self._gradio_first_fail_ts = 0.0
+        self._gradio_skip_until = 0.0
 
         # Debug Logging
         if self.gemini_keys:
@@ -43,21 +487,61 @@ class AIService:
         if not self.replicate_token:
             print("⚠️ Replicate Service: No Token found")
 
-    def _get_genai_module(self):
+    def _preload_modules(self):
+        """
+        Import the heavy SDKs once, off the request path and without slowing server boot.
+        Callers wait on self._modules_ready before reading self.genai / replicate / gradio_client.
+        """
         try:
-            import google.generativeai as genai
-            return genai
-        except ImportError as e:
-            print(f"Failed to import google.generativeai: {e}")
-            return None
+            try:
+                import google.generativeai as genai
+                self.genai = genai
+            except Exception as e:
+                print(f"Failed to import google.generativeai: {e}")
 
-    def _get_replicate_module(self):
-        try:
-            import replicate
-            return replicate
-        except ImportError as e:
-            print(f"Failed to import replicate: {e}")
-            return None
+            try:
+                import replicate
+                self.replicate = replicate
+            except Exception as e:
+                print(f"Failed to import replicate: {e}")
+
+            try:
+                import gradio_client
+                self.gradio_client = gradio_client
+            except Exception as e:
+                print(f"Failed to import gradio_client: {e}")
+        finally:
+            self._modules_ready.set()
+
+    async def _wait_for_modules(self):
+        """
+        Async counterpart of self._modules_ready.wait() that doesn't block the event loop.
+        """
+        if not self._modules_ready.is_set():
+            await asyncio.to_thread(self._modules_ready.wait)
+
+    def _gradio_healthy(self) -> bool:
+        """
+        False while the Gradio Space is in its failure cooldown window.
+        """
+        return time.time() >= self._gradio_skip_until
+
+    def _record_gradio_result(self, success: bool):
+        if success:
+            self._gradio_fail_count = 0
+            return
+
+        now = time.time()
+        if now - self._gradio_first_fail_ts > GRADIO_FAIL_WINDOW:
+            # Start a new failure window
+            self._gradio_fail_count = 0
+            self._gradio_first_fail_ts = now
+        self._gradio_fail_count += 1
+
+        if self._gradio_fail_count >= GRADIO_FAIL_THRESHOLD:
+            print(f"⚠️ Gradio failed {self._gradio_fail_count} times in {GRADIO_FAIL_WINDOW}s. Skipping it for {GRADIO_COOLDOWN}s.")
+            self._gradio_skip_until = now + GRADIO_COOLDOWN
+            self._gradio_fail_count = 0
 
     def _mock_analysis(self, reason: str = "") -> dict:
         # MOCK RESPONSE (Fallback)
@@ -68,68 +552,247 @@ class AIService:
             "style": f"時尚休閒{suffix}"
         }
 
-    def analyze_image_style(self, image_bytes: bytes) -> dict:
+    def _cache_key(self, purpose: str, image_bytes: bytes) -> str:
+        return hashlib.sha256(purpose.encode() + b":" + image_bytes).hexdigest()
+
+    def _cache_get(self, key: str):
+        """
+        Look up a Gemini result: memory first, then the on-disk copy (survives restarts/workers).
+        """
+        with self._cache_lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+
+        try:
+            with open(os.path.join(GEMINI_CACHE_DIR, key[:2], key), "rb") as f:
+                value = _json_loads(f.read())
+        except (OSError, ValueError):
+            return None
+        self._cache_put(key, value, persist=False)
+        return value
+
+    def _cache_put(self, key: str, value: dict, persist: bool = True):
+        with self._cache_lock:
+            self._cache[key] = value
+            self._cache.move_to_end(key)
+            while len(self._cache) > GEMINI_CACHE_SIZE:
+                self._cache.popitem(last=False)
+
+        if persist:
+            try:
+                shard = os.path.join(GEMINI_CACHE_DIR, key[:2])
+                os.makedirs(shard, exist_ok=True)
+                with open(os.path.join(shard, key), "w", encoding="utf-8") as f:
+                    json.dump(value, f, ensure_ascii=False)
+            except OSError as e:
+                print(f"Gemini cache write failed: {e}")
+
+    def _load_model_stats(self) -> dict:
+        try:
+            with open(GEMINI_STATS_PATH, "rb") as f:
+                stats = _json_loads(f.read())
+            return {m: list(v) for m, v in stats.items() if m in self.gemini_models}
+        except (OSError, ValueError):
+            return {}
+
+    def _record_model_result(self, model_name: str, success: bool):
+        stats = self._model_stats.setdefault(model_name, [0, 0, 0.0])
+        if success:
+            stats[0] += 1
+            stats[2] = time.time()
+        else:
+            stats[1] += 1
+        self._stats_dirty = True
+
+        now = time.monotonic()
+        if now - self._stats_saved_at >= GEMINI_STATS_SAVE_INTERVAL:
+            self._stats_saved_at = now
+            self._stats_dirty = False
+            # Snapshot now; the file write happens on the stats thread
+            snapshot = {m: list(v) for m, v in self._model_stats.items()}
+            self._stats_pool.submit(self._save_model_stats, snapshot)
+
+    def _flush_model_stats(self):
+        """
+        Write counters not yet persisted (at exit).
+        """
+        if self._stats_dirty:
+            self._stats_dirty = False
+            self._save_model_stats({m: list(v) for m, v in self._model_stats.items()})
+
+    @staticmethod
+    def _save_model_stats(stats: dict):
+        try:
+            tmp_path = f"{GEMINI_STATS_PATH}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(stats, f)
+            os.replace(tmp_path, GEMINI_STATS_PATH)
+        except OSError as e:
+            print(f"Gemini stats write failed: {e}")
+
+    def _ranked_models(self) -> list:
+        """
+        self.gemini_models ordered by observed success rate, then most recent success.
+        Rates are smoothed ((s+1)/(s+f+2)) so untried models start in the middle;
+        ties keep the declared order.
+        """
+        def rank(model_name):
+            success, fail, last_success = self._model_stats.get(model_name, (0, 0, 0.0))
+            return (-(success + 1) / (success + fail + 2), -last_success)
+        return sorted(self.gemini_models, key=rank)
+
+    def _get_model(self, genai, key, model_name):
+        """
+        GenerativeModel per (key, model), reused across requests so its client/channel is too.
+        The async client is tied to the event loop it first ran on (the app's loop).
+        """
+        model = self._models.get((key, model_name))
+        if model is None:
+            # configure() is global, but a new model binds its client on its first
+            # generate call, which callers make right away (no await in between).
+            genai.configure(api_key=key)
+            model = genai.GenerativeModel(model_name)
+            self._models[(key, model_name)] = model
+        return model
+
+    async def _gemini_attempt(self, genai, key, model_name, contents, parse, purpose):
+        """
+        One Gemini call. Returns (key, model_name, ok, result_or_error) instead of raising,
+        so concurrent attempts can be consumed with asyncio.as_completed.
+        """
+        try:
+            print(f"Trying Gemini Model: {model_name}{purpose}...")
+            model = self._get_model(genai, key, model_name)
+            response = await model.generate_content_async(contents)
+            return key, model_name, True, parse(response.text)
+        except Exception as e:
+            return key, model_name, False, e
+
+    def _record_gemini_error(self, key, model_name, error, errors):
+        error_msg = str(error)
+        # Include Key hint in error log
+        key_hint = f"...{key[-4:]}"
+        errors.append(f"Key({key_hint})/{model_name}: {error_msg}")
+        if "404" in error_msg:
+            # Model not available for this key: don't ask again
+            self._dead_models.add((key, model_name))
+            self._record_model_result(model_name, False)
+        elif "429" in error_msg or "quota" in error_msg.lower() or "RESOURCE_EXHAUSTED" in error_msg:
+            # The key's fault, not the model's: no stats update
+            self._buckets[key].on_rate_limited()
+            self._key_cooldown[key] = time.time() + GEMINI_KEY_COOLDOWN
+        else:
+            self._record_model_result(model_name, False)
+
+    async def _generate_with_rotation(self, genai, contents, parse, purpose: str = ""):
+        """
+        Call Gemini with Key/Model rotation, respecting each key's token bucket.
+        Combinations are tried GEMINI_PARALLEL_ATTEMPTS at a time; the first success
+        cancels the rest of its wave.
+        Returns (parse(response.text), errors) for the first attempt that succeeds,
+        or (None, errors) when every attempt failed.
+        """
+        errors = []
+        # Round-robin start so concurrent requests begin on different keys
+        with self._key_lock:
+            start_key_idx = next(self._key_cycle)
+        rotated_keys = self.gemini_keys[start_key_idx:] + self.gemini_keys[:start_key_idx]
+        deadline = time.monotonic() + GEMINI_WAIT_TIMEOUT
+
+        while True:
+            attempted = False
+            waits = []
+            per_key = []
+            models = self._ranked_models()
+            for key in rotated_keys:
+                # Key still in its quota penalty
+                cooldown_left = self._key_cooldown.get(key, 0) - time.time()
+                if cooldown_left > 0:
+                    waits.append(cooldown_left)
+                    continue
+                per_key.append([(key, m) for m in models if (key, m) not in self._dead_models])
+
+            # Interleave keys (k1/m1, k2/m1, ..., k1/m2, ...) so a wave spreads over several quotas
+            combos = [c for group in itertools.zip_longest(*per_key) for c in group if c]
+
+            pos = 0
+            while pos < len(combos):
+                wave = []
+                while pos < len(combos) and len(wave) < GEMINI_PARALLEL_ATTEMPTS:
+                    key, model_name = combos[pos]
+                    pos += 1
+                    if time.time() < self._key_cooldown.get(key, 0):
+                        # Got rate limited in an earlier wave
+                        continue
+                    bucket = self._buckets[key]
+                    if not bucket.try_acquire():
+                        # Key is out of budget, try the next combination
+                        waits.append(bucket.wait_time())
+                        continue
+                    wave.append((key, model_name))
+                if not wave:
+                    continue
+
+                attempted = True
+                tasks = [asyncio.create_task(self._gemini_attempt(genai, key, model_name, contents, parse, purpose))
+                         for key, model_name in wave]
+                try:
+                    for next_done in asyncio.as_completed(tasks):
+                        key, model_name, ok, value = await next_done
+                        if ok:
+                            self._buckets[key].on_success()
+                            self._record_model_result(model_name, True)
+                            return value, errors
+                        self._record_gemini_error(key, model_name, value, errors)
+                finally:
+                    for t in tasks:
+                        t.cancel()
+
+            if attempted:
+                return None, errors
+            if not waits:
+                errors.append("NoModel: no available model for any key")
+                return None, errors
+
+            # Every key is out of budget or cooling down: wait for the soonest one
+            wait = min(waits)
+            if time.monotonic() + wait > deadline:
+                errors.append(f"RateLimit: all {len(rotated_keys)} keys out of budget or cooling down")
+                return None, errors
+            print(f"Gemini budget exhausted, waiting {wait:.1f}s for a token...")
+            await asyncio.sleep(wait)
+
+    async def analyze_image_style(self, image_bytes: bytes) -> dict:
         """
         Analyze image style using Google Gemini with Key/Model Rotation.
-        Also tries to detect the body position for overlay mapping.
         """
         if not self.gemini_keys:
             print("Gemini API key not found. Using mock response.")
             return self._mock_analysis("無 API Key")
 
-        genai = self._get_genai_module()
+        cache_key = self._cache_key("style", image_bytes)
+        cached = self._cache_get(cache_key)
+        if cached is not None:
+            print("Gemini style analysis: cache hit")
+            return cached
+
+        await self._wait_for_modules()
+        genai = self.genai
         if not genai:
             print("Gemini module not available.")
             return self._mock_analysis("無法載入 Google 模組")
 
-        # Complex Prompt: asking for Style + Bounding Box
-        prompt = """
-        請分析這張全身照或半身照。
-        請回傳一個 JSON 物件，包含以下欄位：
-        1. "name": 適合這張圖片中衣著的簡短名稱。
-        2. "style": 風格 (例如：休閒、正式)。
-        3. "shoulders": 肩膀寬度 (估計值，相對於圖片寬度的比例，例如 0.4)。
-        4. "torso_center_x": 軀幹中心點 X 座標 (0.0-1.0)。
-        5. "torso_center_y": 軀幹中心點 Y 座標 (0.0-1.0)。
-        6. "torso_height": 軀幹高度 (估計值，0.0-1.0)。
-        
-        如果無法辨識人物，請回傳預設值。
-        請直接回傳 JSON，不要 markdown 格式。
-        """
+        prompt = STYLE_PROMPT
 
         # Prepare image part
-        image_part = {
-            "mime_type": "image/jpeg",
-            "data": image_bytes
-        }
-
-        # Rotation Logic
-        errors = []
-        start_key_idx = random.randint(0, len(self.gemini_keys) - 1)
-        rotated_keys = self.gemini_keys[start_key_idx:] + self.gemini_keys[:start_key_idx]
-        
-        for key in rotated_keys:
-            genai.configure(api_key=key)
-            
-            for model_name in self.gemini_models:
-                try:
-                    # FIX: Use loop variable model_name instead of hardcoded value
-                    print(f"Trying Gemini Model: {model_name}...")
-                    model = genai.GenerativeModel(model_name)
-                    
-                    response = model.generate_content([prompt, image_part])
-                    text = response.text.replace("```json", "").replace("```", "").strip()
-                    result = json.loads(text)
-                    return result
+        image_part = _gemini_image_part(image_bytes)
 
-                except Exception as e:
-                    error_msg = str(e)
-                    # Include Key hint in error log
-                    key_hint = f"...{key[-4:]}"
-                    errors.append(f"Key({key_hint})/{model_name}: {error_msg}")
-                    # Basic rotation logic same as before...
-                    if "404" in error_msg:
-                        continue
+        result, errors = await self._generate_with_rotation(genai, [prompt, image_part], _parse_gemini_json)
+        if result is not None:
+            # Only real answers are cached; mock/error results should be retried next time
+            self._cache_put(cache_key, result)
+            return result
         
         # If all failed, use the last error as reason
         last_error = errors[-1] if errors else "Unknown Error"
@@ -152,225 +815,184 @@ class AIService:
         key_count = len(self.gemini_keys)
         return self._mock_analysis(f"Err({key_count} keys): {short_error}")
 
-    def _remove_background_simple(self, img):
+    def analyze_image_style_batch(self, items: List[tuple], timeout: float = 24 * 3600) -> Dict[str, dict]:
         """
-        Simple color-keying to remove white/light background.
-        Converts white/light-gray pixels to transparent.
+        Analyze many (id, image_bytes) pairs through Gemini Batch Mode.
+        Blocking (polls until the job finishes) - meant for offline scripts like batch_process.py.
+        Returns {id: {"name", "style"}} for the items that succeeded; callers fall back to
+        analyze_image_style for the rest. Needs the google-genai SDK.
         """
+        if not items or not self.gemini_keys:
+            return {}
+
         try:
-            from PIL import Image
-            img = img.convert("RGBA")
-            datas = img.getdata()
-            
-            new_data = []
-            for item in datas:
-                # RGB values + Alpha
-                # Check if pixel is close to white (e.g. > 200 in all channels)
-                if item[0] > 200 and item[1] > 200 and item[2] > 200:
-                    new_data.append((255, 255, 255, 0)) # Make transparent
-                else:
-                    new_data.append(item)
-            
-            img.putdata(new_data)
-            return img
+            from google import genai as google_genai
+        except ImportError:
+            print("google-genai SDK not installed. Batch Mode unavailable.")
+            return {}
+
+        client = google_genai.Client(api_key=self.gemini_keys[0])
+
+        # 1. Write the JSONL request file
+        jsonl_path = os.path.join(tempfile.gettempdir(), f"style_batch_{int(time.time())}.jsonl")
+        with open(jsonl_path, "w", encoding="utf-8") as f:
+            for item_id, image_bytes in items:
+                image_part = _gemini_image_part(image_bytes)
+                line = {
+                    "key": str(item_id),
+                    "request": {
+                        "contents": [{"parts": [
+                            {"text": STYLE_PROMPT},
+                            {"inline_data": {"mime_type": image_part["mime_type"],
+                                             "data": base64.b64encode(image_part["data"]).decode("ascii")}}
+                        ]}],
+                        "generation_config": {"response_mime_type": "application/json"}
+                    }
+                }
+                f.write(json.dumps(line, ensure_ascii=False) + "\n")
+
+        results = {}
+        try:
+            # 2. Upload and submit
+            uploaded = client.files.upload(file=jsonl_path, config={"mime_type": "jsonl"})
+            job = client.batches.create(model=GEMINI_BATCH_MODEL, src=uploaded.name,
+                                        config={"display_name": os.path.basename(jsonl_path)})
+            print(f"Gemini batch submitted: {job.name} ({len(items)} items)")
+
+            # 3. Poll until done
+            done_states = {"JOB_STATE_SUCCEEDED", "JOB_STATE_FAILED", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED"}
+            deadline = time.time() + timeout
+            while job.state.name not in done_states:
+                if time.time() > deadline:
+                    print(f"Gemini batch {job.name} still {job.state.name} after {timeout}s. Giving up.")
+                    return results
+                time.sleep(GEMINI_BATCH_POLL)
+                job = client.batches.get(name=job.name)
+
+            if job.state.name != "JOB_STATE_SUCCEEDED":
+                print(f"Gemini batch {job.name} ended with {job.state.name}")
+                return results
+
+            # 4. Parse the result file
+            content = client.files.download(file=job.dest.file_name)
+            for raw in content.decode("utf-8").splitlines():
+                if not raw.strip():
+                    continue
+                line = _json_loads(raw)
+                try:
+                    text = line["response"]["candidates"][0]["content"]["parts"][0]["text"]
+                    results[line["key"]] = _parse_gemini_json(text)
+                except Exception as e:
+                    print(f"Batch item {line.get('key')} failed: {line.get('error', e)}")
         except Exception as e:
-            print(f"BG Removal failed: {e}")
-            return img
+            print(f"Gemini batch failed: {e}")
+            traceback.print_exc()
+        finally:
+            try:
+                os.remove(jsonl_path)
+            except OSError:
+                pass
 
-    def _ensure_aspect_ratio(self, img_bytes, target_ratio=0.75): # 3:4 = 0.75
+        return results
+
+    @staticmethod
+    def _cloth_asset_path(cloth_bytes: bytes, cloth_name: str, category: str):
         """
-        Resize/Pad image to match target aspect ratio (3:4) to prevent distortion.
-        Returns bytes of new image.
+        (ootd_category, path) of the prepared garment canvas for these bytes and category.
         """
-        try:
-            from PIL import Image, ImageOps
-            img = Image.open(io.BytesIO(img_bytes))
-            
-            # Auto-orient (fix EXIF rotation) to ensure correct dimensions
-            img = ImageOps.exif_transpose(img)
-            
-            if img.mode != 'RGB':
-                img = img.convert('RGB')
-                
-            w, h = img.size
-            current_ratio = w / h
-            
-            # Tolerance
-            if abs(current_ratio - target_ratio) < 0.01:
-                return img_bytes
-                
-            # Need to pad
-            if current_ratio < target_ratio:
-                # Too tall (skinny) -> Add padding to sides to make it wider
-                new_w = int(h * target_ratio)
-                new_h = h
-                pad_color = (255, 255, 255) # Assuming white background
-                
-                new_img = Image.new("RGB", (new_w, new_h), pad_color)
-                offset_x = (new_w - w) // 2
-                new_img.paste(img, (offset_x, 0))
-                
-            else:
-                # Too wide -> Add padding to top/bottom
-                new_w = w
-                new_h = int(w / target_ratio)
-                pad_color = (255, 255, 255)
-                
-                new_img = Image.new("RGB", (new_w, new_h), pad_color)
-                offset_y = (new_h - h) // 2
-                new_img.paste(img, (0, offset_y))
-            
-            out_buf = io.BytesIO()
-            new_img.save(out_buf, format='JPEG', quality=95)
-            return out_buf.getvalue()
-            
-        except Exception as e:
-            print(f"Resize failed: {e}")
-            return img_bytes
+        ootd_category = _ootd_category(cloth_name, category)
+        digest = hashlib.sha256(cloth_bytes).hexdigest()
+        return ootd_category, os.path.join(CLOTH_ASSET_DIR, f"{digest}_{ootd_category}.jpg")
+
+    def prepare_cloth_asset(self, cloth_bytes: bytes, cloth_name: str = "Upper-body", category: str = None) -> str:
+        """
+        Trim + standardize a garment for VTON and memoize the result on disk.
+        The canvas only depends on the garment bytes and category, so it is computed
+        once (at upload, or on the first try-on) and reused for every user.
+        Returns the path of the prepared JPEG.
+        """
+        ootd_category, asset_path = self._cloth_asset_path(cloth_bytes, cloth_name, category)
+        if os.path.exists(asset_path):
+            print(f"Using cached garment asset {asset_path}")
+            return asset_path
+
+        os.makedirs(CLOTH_ASSET_DIR, exist_ok=True)
+        tmp_path = f"{asset_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        pool = _garment_pool()
+        if pool is not None:
+            pool.submit(_write_garment_asset, cloth_bytes, ootd_category, tmp_path).result()
+        else:
+            _write_garment_asset(cloth_bytes, ootd_category, tmp_path)
+        os.replace(tmp_path, asset_path) # Atomic: concurrent requests never see a partial file
+
+        print(f"Processed Garment (Standardized) saved to {asset_path}")
+        return asset_path
+
+    async def prepare_cloth_asset_async(self, cloth_bytes: bytes, cloth_name: str = "Upper-body", category: str = None) -> str:
+        """
+        prepare_cloth_asset for async callers: the process pool's future is awaited
+        directly instead of parking a _cpu_pool thread on .result().
+        """
+        pool = _garment_pool()
+        if pool is None:
+            return await self.run_cpu(self.prepare_cloth_asset, cloth_bytes, cloth_name, category)
+
+        ootd_category, asset_path = self._cloth_asset_path(cloth_bytes, cloth_name, category)
+        if os.path.exists(asset_path):
+            print(f"Using cached garment asset {asset_path}")
+            return asset_path
+
+        os.makedirs(CLOTH_ASSET_DIR, exist_ok=True)
+        tmp_path = f"{asset_path}.{os.getpid()}.{id(asyncio.current_task())}.tmp"
+        await asyncio.get_running_loop().run_in_executor(pool, _write_garment_asset, cloth_bytes, ootd_category, tmp_path)
+        os.replace(tmp_path, asset_path)
+
+        print(f"Processed Garment (Standardized) saved to {asset_path}")
+        return asset_path
 
     def _try_on_gradio(self, person_bytes, cloth_path, cloth_name="Upper-body", category=None, height_ratio=None):
         """
         Try using free OOTDiffusion via Gradio Client.
         """
         try:
-            try:
-                from gradio_client import Client, handle_file
-            except ImportError as ie:
-                print(f"CRITICAL: gradio_client import failed. {ie}")
+            ootd_category = _ootd_category(cloth_name, category)
+
+            with open(cloth_path, "rb") as f:
+                cloth_bytes = f.read()
+
+            # Diffusion runs take 20-60s: reuse the result for an identical (person, cloth, category)
+            tryon_key = f"{hashlib.sha256(person_bytes).hexdigest()}_{hashlib.sha256(cloth_bytes).hexdigest()}_{ootd_category}"
+            tryon_path = os.path.join(TRYON_CACHE_DIR, f"{tryon_key}.jpg")
+            if os.path.exists(tryon_path):
+                print("OOTDiffusion: cache hit")
+                with open(tryon_path, "rb") as f:
+                    return f.read()
+
+            self._modules_ready.wait()
+            if not self.gradio_client:
+                print("CRITICAL: gradio_client import failed.")
                 raise Exception("Server Error: Missing gradio_client library.")
+            Client, handle_file = self.gradio_client.Client, self.gradio_client.handle_file
             
+            # Connect to the Space in the background: Client() fetches the Space config over
+            # the network, which now overlaps with the garment/person preparation below.
+            connect_pool = ThreadPoolExecutor(max_workers=1)
+            client_future = connect_pool.submit(Client, "levihsu/OOTDiffusion", httpx_kwargs={"timeout": 25})
+            connect_pool.shutdown(wait=False)
+
             # PRE-PROCESS: Ensure 3:4 Aspect Ratio to prevent distortion (Skipped if we trust input)
             # Default input logic handles person image.
             
-            # Determine category
-            if not category:
-                if "裙" in cloth_name or "洋裝" in cloth_name:
-                    category = "Dress"
-                elif "褲" in cloth_name:
-                    category = "Lower-body"
-                else:
-                    category = "Upper-body"
-
-            # Map to OOTD strings
-            ootd_category = "Upper-body"
-            if category.lower() in ["lower-body", "lower_body", "bottom"]:
-                ootd_category = "Lower-body"
-            elif category.lower() in ["dress", "dresses", "whole-body", "whole_body"]:
-                ootd_category = "Dress"
-            
-            from PIL import Image, ImageChops
-            import io
-            import time
-            import os
-            import tempfile
-            
-            def trim(im):
-                bg = Image.new(im.mode, im.size, im.getpixel((0,0)))
-                diff = ImageChops.difference(im, bg)
-                diff = ImageChops.add(diff, diff, 2.0, -100)
-                bbox = diff.getbbox()
-                if bbox:
-                    return im.crop(bbox)
-                return im
-
-            with open(cloth_path, "rb") as f:
-                raw_c_img = Image.open(f).convert("RGB")
-        
-            # 1. Trim (Remove borders)
-            c_img_trimmed = trim(raw_c_img)
-            
-            # 2. Standardize for VTON (768x1024 Canvas)
-            # This ensures OOTD receives a high-quality, centered input regardless of original crop.
-            canvas_w, canvas_h = 768, 1024
-            
-            # Fit garment into canvas
-            # Adjust coverage based on category
-            target_coverage_w = 0.9
-            target_coverage_h = 0.9
-            
-            c_w, c_h = c_img_trimmed.size
-            
-            if ootd_category == "Lower-body":
-                 # PANTS FIX (Texture Preservation):
-                 # Problem: Stretching distorted the texture (e.g. Plaid), creating weird artifacts.
-                 # Problem: Wide inputs became shorts.
-                 # Solution: CROP the sides of the input garment to force a "Tall" aspect ratio WITHOUT stretching.
-                 
-                 # 1. Check Aspect Ratio
-                 c_aspect = c_w / c_h
-                 target_aspect = 0.55 # Target: Slim Tall Pants
-                 
-                 if c_aspect > target_aspect:
-                     # Too Wide!
-                     # Calculate new width to match target aspect ratio based on height
-                     new_source_w = int(c_h * target_aspect)
-                     
-                     # Center Crop
-                     left = (c_w - new_source_w) // 2
-                     right = left + new_source_w
-                     print(f"Pants too wide ({c_aspect:.2f}). Cropping width from {c_w} to {new_source_w} to force Long Pants...")
-                     
-                     c_img_trimmed = c_img_trimmed.crop((left, 0, right, c_h))
-                     c_w, c_h = c_img_trimmed.size # Update dimensions
-                 
-                 # 2. Scale to Canvas
-                 # Now proper aspect ratio is guaranteed. Scale to Height.
-                 target_h = int(canvas_h * 0.92) # 92% Height (Ankle)
-                 
-                 scale = target_h / c_h
-                 new_w = int(c_w * scale)
-                 new_h = target_h
-                 
-                 # Cap width if it exceeds canvas (unlikely after crop, but good for safety)
-                 if new_w > int(canvas_w * 0.9):
-                      scale = (canvas_w * 0.9) / c_w
-                      new_w = int(c_w * scale)
-                      new_h = int(c_h * scale)
-
-                 c_img_resized = c_img_trimmed.resize((new_w, new_h), Image.Resampling.LANCZOS)
-                 
-                 # 3. Position (Centered-ish)
-                 # Shift slightly down to ensure waist isn't too high
-                 paste_x = (canvas_w - new_w) // 2
-                 paste_y = canvas_h - new_h # Flush Bottom
-                 
-            else:
-                 # Standard logic for Check/Upper/Dress (Centered)
-                 scale = min((canvas_w * target_coverage_w) / c_w, (canvas_h * target_coverage_h) / c_h)
-                 new_w = int(c_w * scale)
-                 new_h = int(c_h * scale)
-                 c_img_resized = c_img_trimmed.resize((new_w, new_h), Image.Resampling.LANCZOS)
-                 
-                 paste_x = (canvas_w - new_w) // 2
-                 paste_y = (canvas_h - new_h) // 2
-            
-            # Paste on White Canvas
-            final_cloth = Image.new("RGB", (canvas_w, canvas_h), (255, 255, 255))
-            final_cloth.paste(c_img_resized, (paste_x, paste_y))
-            
-            if ootd_category == "Lower-body":
-                 print(f"Pants Layout: SIDE-CROP - Size {c_img_resized.size}")
-            
-            # Save processed cloth
-            proc_cloth_path = os.path.join(tempfile.gettempdir(), f"proc_cloth_{int(time.time())}.jpg")
-            final_cloth.save(proc_cloth_path, format="JPEG", quality=95)
-            
-            print(f"Processed Garment (Standardized) saved to {proc_cloth_path}")
+            # Standardized garment canvas, cached per (garment, category)
+            proc_cloth_path = self.prepare_cloth_asset(cloth_bytes, cloth_name, category)
             
             # PRE-PROCESS: Smart Padding to 3:4
             # OOTD works best at 3:4 (0.75). Inputting other ratios causes hidden cropping/zooming.
             # We must PAD the input to 3:4, run VTON, then CROP back to original.
             
-            from PIL import Image, ImageOps
-            import io
-            
-            # Restore missing logic: Save person_bytes to file first
-            person_path = os.path.join(tempfile.gettempdir(), f"person_{int(time.time())}.jpg")
-            with open(person_path, "wb") as f:
-                f.write(person_bytes)
-            
-            with open(person_path, "rb") as f:
-                orig_pil = Image.open(f).convert("RGB")
+            # Decode straight from memory; only the padded image needs to hit disk
+            with Image.open(io.BytesIO(person_bytes)) as f:
+                orig_pil = f.convert("RGB")
                 
             orig_w, orig_h = orig_pil.size
             target_ratio = 0.75 # 3:4
@@ -407,14 +1029,16 @@ class AIService:
                 padded_pil = orig_pil
             
             # Save Padded Person for OOTD
-            padded_person_path = os.path.join(tempfile.gettempdir(), f"person_padded_{int(time.time())}.jpg")
-            padded_pil.save(padded_person_path, format="JPEG", quality=95)
+            # Unique per request (removed below); fast encode, q90 is plenty for the diffusion input
+            with tempfile.NamedTemporaryFile(prefix="person_padded_", suffix=".jpg", delete=False) as tmp:
+                padded_pil.save(tmp, format="JPEG", quality=90, subsampling=2, optimize=False)
+                padded_person_path = tmp.name
             
             print(f"Padded Person saved to {padded_person_path} (Ratio: {current_ratio:.2f} -> {target_ratio})")
 
             try:
                 print(f"Connecting to Gradio Space (OOTDiffusion) for {ootd_category}...")
-                client = Client("levihsu/OOTDiffusion")
+                client = client_future.result(timeout=30)
                 
                 # Call Gradio Client
                 # Using 'levihsu/OOTDiffusion'
@@ -500,9 +1124,17 @@ class AIService:
                              res_cropped = res_pil
                              
                          # Convert to bytes
-                         buf = io.BytesIO()
-                         res_cropped.save(buf, format="JPEG", quality=95)
-                         return buf.getvalue()
+                         result_bytes = _encode_image(res_cropped)
+
+                         try:
+                             os.makedirs(TRYON_CACHE_DIR, exist_ok=True)
+                             tmp_path = f"{tryon_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                             with open(tmp_path, "wb") as f:
+                                 f.write(result_bytes)
+                             os.replace(tmp_path, tryon_path)
+                         except OSError as e:
+                             print(f"Try-on cache write failed: {e}")
+                         return result_bytes
                          
                 else:
                      print("GenAI returned invalid path.")
@@ -511,14 +1143,18 @@ class AIService:
             except Exception as e:
                 print(f"GenAI Call Error: {e}")
                 raise e # Re-raise to ensure main handler catches it
+            finally:
+                try:
+                    os.unlink(padded_person_path)
+                except OSError:
+                    pass
 
         except Exception as e:
             print(f"Gradio VTON Setup/Run Failed: {e}")
-            import traceback
             traceback.print_exc()
             raise Exception(f"VTON Error: {str(e)[:100]}")
 
-    def validate_and_crop_user_photo(self, img_bytes: bytes) -> Dict:
+    async def validate_and_crop_user_photo(self, img_bytes: bytes) -> Dict:
         """
         Validate and Auto-Crop User Photo.
         Returns:
@@ -533,9 +1169,18 @@ class AIService:
              # Fallback to REJECT to prevent bypassing checks.
              return {"valid": False, "reason": "系統設定錯誤：未檢測到 AI 金鑰 (GEMINI_API_KEY)，無法進行驗證。", "processed_image": None}
 
-        genai = self._get_genai_module()
+        await self._wait_for_modules()
+        genai = self.genai
         if not genai:
             return {"valid": False, "reason": "系統環境錯誤：缺少 Google GenAI 模組。", "processed_image": None}
+
+        # Same photo re-submitted: reuse the previous verdict
+        cache_key = self._cache_key("validate", img_bytes)
+        cached = self._cache_get(cache_key)
+        if cached is not None:
+            print("Photo validation: cache hit")
+            return {"valid": cached["valid"], "reason": cached["reason"],
+                    "processed_image": img_bytes if cached["valid"] else None}
             
         # 1. Gemini Analysis
         prompt = """
@@ -553,28 +1198,20 @@ class AIService:
         回傳 JSON: {"valid": bool, "reason": str, "box_2d": [ymin, xmin, ymax, xmax], "is_single": bool, "is_front": bool, "is_full_body": bool}
         """
         
-        image_part = {"mime_type": "image/jpeg", "data": img_bytes}
+        image_part = _gemini_image_part(img_bytes)
         
         # Simple Rotation for single call
         key = self.gemini_keys[0] # Just use first key for this helper
-        genai.configure(api_key=key)
         # updated model name to stable version
         # gemini-1.5-flash gave 404. Using gemini-flash-latest which is confirmed available.
-        model = genai.GenerativeModel('gemini-flash-latest') 
+        model = self._get_model(genai, key, 'gemini-flash-latest')
         
         try:
-            response = model.generate_content([prompt, image_part])
+            response = await model.generate_content_async([prompt, image_part])
             
             # Robust Parsing
             try:
-                text = response.text.replace("```json", "").replace("```", "").strip()
-                # Find first { and last }
-                start = text.find("{")
-                end = text.rfind("}") + 1
-                if start != -1 and end != 0:
-                    text = text[start:end]
-                    
-                data = json.loads(text)
+                data = _parse_gemini_json(response.text)
             except Exception as parse_err:
                 print(f"JSON Parse Error: {parse_err}. Raw Text: {response.text}")
                 # FAIL OPEN: If AI messes up formatting, assume valid to avoid blocking user.
@@ -591,11 +1228,13 @@ class AIService:
                 full_reason = "、".join(reasons)
                 if not full_reason: full_reason = data.get("reason", "照片不符規格")
                 
+                self._cache_put(cache_key, {"valid": False, "reason": full_reason})
                 return {"valid": False, "reason": full_reason, "processed_image": None}
             
             # User Request: "If valid, do not move/resize photo". 
             # We skip all auto-crop logic and return original bytes.
             print("Validation Passed. Keeping original image as requested.")
+            self._cache_put(cache_key, {"valid": True, "reason": "OK (Original Kept)"})
             return {"valid": True, "reason": "OK (Original Kept)", "processed_image": img_bytes}
 
         except Exception as e:
@@ -603,230 +1242,365 @@ class AIService:
             # Strict Failure: Do not allow bypass on error
             return {"valid": False, "reason": f"AI 驗證連線失敗: {str(e)}", "processed_image": None}
 
-    def _add_watermark(self, img_bytes: bytes, text: str = "此為試穿效果，並非真實穿著樣貌") -> bytes:
+    def _get_font(self, font_size: int):
         """
-        Add a disclaimer watermark to the bottom of the image.
+        Watermark font for a given size; truetype() re-reads the font file, so cache it.
         """
-        try:
-            from PIL import Image, ImageDraw, ImageFont
-            img = Image.open(io.BytesIO(img_bytes)).convert("RGB")
-            draw = ImageDraw.Draw(img)
-            w, h = img.size
-            
-            # Font Setup
-            # Try loading standard Chinese font on Windows
-            font_path = "C:/Windows/Fonts/msjh.ttc" 
-            if not os.path.exists(font_path):
-                 # Fallback to standard arial if Chinese font missing (unlikely on TW Windows)
-                 font_path = "arial.ttf"
-            
-            # Dynamic font size (approx 2.5% of image height)
-            font_size = int(h * 0.025)
-            font_size = max(16, font_size) # Min size
-            
+        font = self._font_cache.get(font_size)
+        if font is None:
             try:
-                font = ImageFont.truetype(font_path, font_size)
+                font = ImageFont.truetype(self._font_path, font_size)
             except:
                 font = ImageFont.load_default()
-            
-            # Calculate Text Size
-            # getting text bbox: left, top, right, bottom
-            bbox = draw.textbbox((0, 0), text, font=font)
-            text_w = bbox[2] - bbox[0]
-            text_h = bbox[3] - bbox[1]
-            
-            # Position: Bottom Center with padding
-            x = (w - text_w) // 2
-            y = h - text_h - 20 # 20px padding from bottom
-            
-            # Draw Outline (Shadow) for visibility
-            outline_color = (0, 0, 0)
-            text_color = (255, 255, 255)
-            
-            # Draw outline by drawing text at offsets
-            draw.text((x-1, y-1), text, font=font, fill=outline_color)
-            draw.text((x+1, y-1), text, font=font, fill=outline_color)
-            draw.text((x-1, y+1), text, font=font, fill=outline_color)
-            draw.text((x+1, y+1), text, font=font, fill=outline_color)
-            
-            # Draw Main Text
-            draw.text((x, y), text, font=font, fill=text_color)
-            
-            output = io.BytesIO()
-            img.save(output, format="JPEG", quality=95)
-            return output.getvalue()
+            self._font_cache[font_size] = font
+        return font
+
+    def _watermark_overlay(self, w: int, h: int, text: str):
+        """
+        RGBA strip holding the outlined disclaimer text for a w x h image, plus its top offset.
+        Rendered once per size and kept in a small LRU.
+        """
+        key = (w, h, text)
+        with self._wm_lock:
+            hit = self._wm_overlay_cache.get(key)
+            if hit is not None:
+                self._wm_overlay_cache.move_to_end(key)
+                return hit
+
+        # Dynamic font size (approx 2.5% of image height)
+        font_size = int(h * 0.025)
+        font_size = max(16, font_size) # Min size
+        
+        font = self._get_font(font_size)
+        
+        # Outline (Shadow) for visibility, drawn as a stroke in the same pass as the text
+        outline_color = (0, 0, 0, 255)
+        text_color = (255, 255, 255, 255)
+        stroke = 1
+        
+        # Calculate Text Size
+        # getting text bbox: left, top, right, bottom
+        bbox = font.getbbox(text, stroke_width=stroke)
+        text_w = bbox[2] - bbox[0]
+        text_h = bbox[3] - bbox[1]
+        
+        # Position: Bottom Center with padding
+        x = (w - text_w) // 2
+        y = h - text_h - 20 # 20px padding from bottom
+        
+        # Only the band the text touches is stored; it is pasted back at `top`
+        top = max(0, y + bbox[1])
+        overlay = Image.new("RGBA", (w, max(1, h - top)), (0, 0, 0, 0))
+        ImageDraw.Draw(overlay).text((x, y - top), text, font=font, fill=text_color, stroke_width=stroke, stroke_fill=outline_color)
+        
+        with self._wm_lock:
+            self._wm_overlay_cache[key] = (overlay, top)
+            while len(self._wm_overlay_cache) > WATERMARK_CACHE_SIZE:
+                self._wm_overlay_cache.popitem(last=False)
+        return overlay, top
+
+    def _add_watermark(self, img, text: str = "此為試穿效果，並非真實穿著樣貌", fmt: str = "JPEG") -> bytes:
+        """
+        Add a disclaimer watermark to the bottom of an RGB PIL image (composited in place).
+        The result is encoded as `fmt` ("JPEG" or "WEBP").
+        """
+        try:
+            overlay, top = self._watermark_overlay(img.width, img.height, text)
+            img.paste(overlay, (0, top), overlay)
+            return _encode_image(img, fmt)
             
         except Exception as e:
             print(f"Watermark failed: {e}")
-            return img_bytes
+            return _encode_image(img, fmt)
 
-    def virtual_try_on(self, person_img_bytes: bytes, cloth_img_path: str, cloth_name: str = "Upper-body", category: str = "Upper-body", method: str = "auto", height_ratio: float = None) -> bytes:
+    def _try_on_replicate(self, person_img_bytes: bytes, cloth_img_path: str, category: str):
         """
-        Virtual Try-On Pipeline:
-        1. Replicate (Paid, Best) - Skipped if no token.
-        2. Gradio OOTDiffusion (Free, Slow, GenAI) - Skipped if method='overlay'
-        3. Gemini Overlay (Free, Fast, 2D) - Fallback or Explicit.
+        Run idm-vton on Replicate. Returns the result as a PIL image (None if the download failed).
+        """
+        output = self._replicate_predict(person_img_bytes, cloth_img_path, category)
+        return self._download_result(output) if output else None
+
+    def _replicate_predict(self, person_img_bytes: bytes, cloth_img_path: str, category: str):
         """
+        The blocking Replicate prediction. Returns the output URL (or None).
+        """
+        print(f"🚀 Starting Replicate processing...")
+        # Pre-process: Removed automated background removal due to Vercel size limits.
+        # User is advised to upload PNGs with transparency if needed.
+
+        # Use Hardcoded Version Hash to avoid "NoneType" error during lookup
+        self._modules_ready.wait()
+        if not self.replicate:
+            raise Exception("Missing replicate library.")
+        client = self.replicate.Client(api_token=self.replicate_token)
         
-        final_result_bytes = None
+        # This is the "cuuupid/idm-vton" model: 0513734a452173b8173e907e3a59d19a36266e55b48528559432bd21c7d7e985
+        model_id = "cuuupid/idm-vton:0513734a452173b8173e907e3a59d19a36266e55b48528559432bd21c7d7e985"
+        print(f"Using Replicate Model: {model_id}")
         
-        # 1. Replicate (Paid, Best)
-        if self.replicate_token and method != 'overlay':
-            try:
-                print(f"🚀 Starting Replicate processing...")
-                # 確保傳入的是二進位數據，而不是路徑
-                with open(cloth_img_path, "rb") as f:
-                    cloth_bytes = f.read()
+        # Prepare Inputs with explicit filenames (Fix for 'Concatenate NoneType' error)
+        # BytesIO shares the upload's buffer (no copy)
+        human_file = io.BytesIO(person_img_bytes)
+        human_file.name = "human.jpg"
 
-                # Pre-process: Removed automated background removal due to Vercel size limits.
-                # User is advised to upload PNGs with transparency if needed.
+        print(f"Human File: Size={len(person_img_bytes)} Name={human_file.name}")
+        print(f"Cloth File: Size={os.path.getsize(cloth_img_path)} Name={cloth_img_path}")
 
-                # Use Hardcoded Version Hash to avoid "NoneType" error during lookup
-                import replicate
-                client = replicate.Client(api_token=self.replicate_token)
-                
-                # This is the "cuuupid/idm-vton" model: 0513734a452173b8173e907e3a59d19a36266e55b48528559432bd21c7d7e985
-                model_id = "cuuupid/idm-vton:0513734a452173b8173e907e3a59d19a36266e55b48528559432bd21c7d7e985"
-                print(f"Using Replicate Model: {model_id}")
-                
-                # Prepare Inputs with explicit filenames (Fix for 'Concatenate NoneType' error)
-                human_file = io.BytesIO(person_img_bytes)
-                human_file.name = "human.jpg"
-                
-                cloth_file = io.BytesIO(cloth_bytes)
-                cloth_file.name = "cloth.jpg"
-
-                print(f"Human File: Size={human_file.getbuffer().nbytes} Name={human_file.name}")
-                print(f"Cloth File: Size={cloth_file.getbuffer().nbytes} Name={cloth_file.name}")
-
-                # Map Frontend Categories to Replicate "upper_body", "lower_body", "dresses"
-                cat_map = {
-                    "upper-body": "upper_body",
-                    "lower-body": "lower_body",
-                    "dresses": "dresses",
-                    # New Fine-grained Lower Body mappings
-                    "mini skirt": "lower_body",
-                    "midi skirt": "lower_body",
-                    "long skirt": "lower_body",
-                    "maxi skirt": "lower_body",
-                    "hot pants": "lower_body",
-                    "capri pants": "lower_body",
-                    "ankle pants": "lower_body",
-                    "trousers": "lower_body"
-                }
-                # Default to upper_body if not found (or if already correct format)
-                api_category = cat_map.get(category.lower(), "upper_body")
-                
-                # Double check validity
-                if api_category not in ["upper_body", "lower_body", "dresses"]:
-                    api_category = "upper_body"
+        api_category = _replicate_category(category)
 
-                # Prepare description hint with stronger keywords for short items
-                raw_cat = category.lower()
-                
-                # Format: "key": ("positive prompt", "negative prompt")
-                prompts_map = {
-                    "mini skirt": ("extremely short micro-mini skirt, high waist, upper thigh length, showing legs, belt skirt", "knee length, midi skirt, long skirt, covering knees, modest"),
-                    "hot pants": ("extremely short hot pants, denim shorts, high cut, showing legs, sexy", "long shorts, knee length, capri, covering legs"),
-                    "midi skirt": ("a knee-length midi skirt", "mini skirt, ankle length, long skirt"),
-                    "capri pants": ("knee-length capri pants", "shorts, ankle length, trousers"),
-                    "long skirt": ("a mid-calf length skirt", "mini skirt, floor length"),
-                    "maxi skirt": ("a long maxi skirt, ankle length", "mini skirt, knee length, showing legs"),
-                    "ankle pants": ("ankle length pants", "shorts, floor length"),
-                    "trousers": ("long trousers, full length pants", "shorts, capri, showing ankles")
+        # Prepare description hint with stronger keywords for short items
+        raw_cat = category.lower()
+        
+        # Format: "key": ("positive prompt", "negative prompt")
+        prompts_map = {
+            "mini skirt": ("extremely short micro-mini skirt, high waist, upper thigh length, showing legs, belt skirt", "knee length, midi skirt, long skirt, covering knees, modest"),
+            "hot pants": ("extremely short hot pants, denim shorts, high cut, showing legs, sexy", "long shorts, knee length, capri, covering legs"),
+            "midi skirt": ("a knee-length midi skirt", "mini skirt, ankle length, long skirt"),
+            "capri pants": ("knee-length capri pants", "shorts, ankle length, trousers"),
+            "long skirt": ("a mid-calf length skirt", "mini skirt, floor length"),
+            "maxi skirt": ("a long maxi skirt, ankle length", "mini skirt, knee length, showing legs"),
+            "ankle pants": ("ankle length pants", "shorts, floor length"),
+            "trousers": ("long trousers, full length pants", "shorts, capri, showing ankles")
+        }
+
+        default_prompt = (f"a {raw_cat.replace('-', ' ')} garment", "")
+        garm_desc, neg_prompt = prompts_map.get(raw_cat, default_prompt)
+        
+        # Hand the SDK the open garment file: it streams it instead of us reading it into memory
+        with open(cloth_img_path, "rb") as cloth_file:
+            output = client.run(
+                model_id,
+                input={
+                    "human_img": human_file, 
+                    "garm_img": cloth_file,
+                    "category": api_category,
+                    # "description": garm_desc, # Some models use 'description'
+                    "garment_des": garm_desc, # Ensure this is passed
+                    "negative_prompt": neg_prompt, # Try passing if supported
+                    "crop": False, 
+                    "steps": 20 
                 }
+            )
+        print(f"Replicate Result URL: {output}")
+        # Replicate returns a URL
+        return output
+
+    def _download_result(self, url):
+        """
+        Download and decode a Replicate output URL. Returns a PIL image or None.
+        """
+        # Decode straight from the socket instead of buffering res.content first
+        with self._http.get(url, stream=True, timeout=(3, 30)) as res:
+            if res.status_code != 200:
+                print(f"Replicate URL download failed: {res.status_code}")
+                return None
+            res.raw.decode_content = True
+            result_img = Image.open(res.raw)
+            result_img.load()
+        print("Replicate success. Image downloaded.")
+        return result_img
+
+    async def _download_result_async(self, url):
+        """
+        _download_result on the shared aiohttp session (worker thread if aiohttp is missing).
+        """
+        if aiohttp is None:
+            return await asyncio.to_thread(self._download_result, url)
+        if self._aio is None or self._aio.closed:
+            self._aio = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=32, keepalive_timeout=60),
+                timeout=aiohttp.ClientTimeout(sock_connect=3, sock_read=30),
+            )
+        async with self._aio.get(str(url)) as res:
+            if res.status != 200:
+                print(f"Replicate URL download failed: {res.status}")
+                return None
+            data = await res.read()
+        print("Replicate success. Image downloaded.")
+        return Image.open(io.BytesIO(data))
+
+    async def _try_on_replicate_async(self, person_img_bytes: bytes, cloth_img_path: str, category: str):
+        output = await asyncio.to_thread(self._replicate_predict, person_img_bytes, cloth_img_path, category)
+        return await self._download_result_async(output) if output else None
+
+    def _run_gradio(self, person_img_bytes, cloth_img_path, cloth_name, category, height_ratio):
+        """
+        OOTDiffusion with the Space health bookkeeping. Returns a PIL image or None.
+        """
+        if not self._gradio_healthy():
+            print("Skipping OOTDiffusion: Space is failing repeatedly (cooldown).")
+            return None
+
+        print(f"Attempting OOTDiffusion (Free GenAI) for {cloth_name} ({category})...")
+        try:
+            gen_img = self._try_on_gradio(person_img_bytes, cloth_img_path, cloth_name, category, height_ratio)
+        except Exception:
+            self._record_gradio_result(False)
+            raise
+        self._record_gradio_result(bool(gen_img))
+        return Image.open(io.BytesIO(gen_img)) if gen_img else None
+
+    def _race_try_on(self, person_img_bytes, cloth_img_path, cloth_name, category, height_ratio):
+        """
+        Run Replicate and Gradio concurrently and return the first non-empty result.
+        Re-raises the last error if both fail.
+        """
+        print("🏁 Racing Replicate and OOTDiffusion...")
+        pool = ThreadPoolExecutor(max_workers=2)
+        futures = [
+            pool.submit(self._try_on_replicate, person_img_bytes, cloth_img_path, category),
+            pool.submit(self._run_gradio, person_img_bytes, cloth_img_path, cloth_name, category, height_ratio),
+        ]
+        # Don't wait for the loser: it finishes (and is discarded) in the background
+        pool.shutdown(wait=False)
+
+        last_error = None
+        try:
+            for future in as_completed(futures, timeout=TRYON_RACE_TIMEOUT):
+                try:
+                    result_img = future.result()
+                except Exception as e:
+                    print(f"Race participant failed: {e}")
+                    last_error = e
+                    continue
+                if result_img is not None:
+                    for other in futures:
+                        other.cancel()
+                    return result_img
+        except FuturesTimeout:
+            print(f"Try-on race timed out after {TRYON_RACE_TIMEOUT}s")
+
+        if last_error:
+            raise last_error
+        return None
+
+    def _should_race(self, api_category: str, method: str) -> bool:
+        # Opt-in (TRYON_RACE=1): run Replicate and Gradio at the same time, first result wins.
+        # Only for upper-body, the one category the Gradio fallback handles.
+        return (TRYON_RACE and bool(self.replicate_token) and method != 'overlay'
+                and api_category == "upper_body" and self._gradio_healthy())
+
+    def _on_replicate_error(self, e: Exception, api_category: str):
+        print(f"Replicate Error Traceback: {traceback.format_exc()}")
+        
+        # CRITICAL: Fallback (Gradio OOTDiffusion) ONLY supports Upper-body.
+        # If we are trying Lower-body or Dress, we CANNOT use fallback.
+        if api_category != "upper_body":
+            print(f"⚠️ Cannot handle {api_category} with fallback. Raising error.")
+            raise Exception(f"Replicate Failed but Fallback only supports Upper-body. Error: {str(e)}")
+
+        print("⚠️ Replicate failed. Falling back to Free Model...")
+
+    def _finish_try_on(self, result_img, person_img_bytes: bytes, output_format: str) -> bytes:
+        """
+        Steps after generation: resize to the original photo size, watermark, encode once.
+        """
+        # 3. Fallback: Removed.
+        # User requested NO overlay/paste results.
+        if result_img is None:
+             print("GenAI failed and Fallback is disabled.")
+             raise Exception("生成失敗：AI 模型無回應，請稍後再試。")
+        
+        result_img = result_img.convert("RGB")
 
-                default_prompt = (f"a {raw_cat.replace('-', ' ')} garment", "")
-                garm_desc, neg_prompt = prompts_map.get(raw_cat, default_prompt)
+        # 4. Post-Process: Resize back to Original Dimensions (User Request)
+        try:
+            # Get original size
+            with Image.open(io.BytesIO(person_img_bytes)) as orig_img:
+                orig_w, orig_h = orig_img.size
                 
-                output = client.run(
-                    model_id,
-                    input={
-                        "human_img": human_file, 
-                        "garm_img": cloth_file,
-                        "category": api_category,
-                        # "description": garm_desc, # Some models use 'description'
-                        "garment_des": garm_desc, # Ensure this is passed
-                        "negative_prompt": neg_prompt, # Try passing if supported
-                        "crop": False, 
-                        "steps": 20 
-                    }
-                )
-                print(f"Replicate Result URL: {output}")
-                if output:
-                    # Replicate returns a URL
-                    import requests
-                    res = requests.get(output)
-                    if res.status_code == 200:
-                        final_result_bytes = res.content
-                        print("Replicate success. Image downloaded.")
-                    else:
-                        print(f"Replicate URL download failed: {res.status_code}")
-                        
+            # Only resize if noticeably different: a few pixels off (e.g. 768x1024 vs 769x1025)
+            # isn't worth a Lanczos pass
+            dw, dh = result_img.width - orig_w, result_img.height - orig_h
+            if max(abs(dw), abs(dh)) > RESIZE_TOLERANCE:
+                print(f"Resizing result from {result_img.size} to original {orig_w}x{orig_h}...")
+                # reducing_gap=3.0: same quality as plain Lanczos, much faster on big downsamples
+                result_img = _resize_image(result_img, (orig_w, orig_h), Image.Resampling.LANCZOS, reducing_gap=3.0)
+        except Exception as e:
+            print(f"Resize Error: {e}")
+
+        # 5. Post-Process: Add Watermark (Prompt), then encode once
+        print("Adding Disclaimer Watermark...")
+        return self._add_watermark(result_img, fmt=output_format)
+
+    def virtual_try_on(self, person_img_bytes: bytes, cloth_img_path: str, cloth_name: str = "Upper-body", category: str = "Upper-body", method: str = "auto", height_ratio: float = None, output_format: str = "JPEG") -> bytes:
+        """
+        Virtual Try-On Pipeline:
+        1. Replicate (Paid, Best) - Skipped if no token.
+        2. Gradio OOTDiffusion (Free, Slow, GenAI) - Skipped if method='overlay'
+        3. Gemini Overlay (Free, Fast, 2D) - Fallback or Explicit.
+        With TRYON_RACE=1, steps 1 and 2 run concurrently for upper-body garments.
+        The final image is encoded as `output_format` ("JPEG" or "WEBP").
+        Blocking; see virtual_try_on_async for the event-loop version.
+        """
+        
+        # Intermediate result is kept decoded (PIL) and encoded once, after the watermark
+        result_img = None
+        
+        api_category = _replicate_category(category)
+        race = self._should_race(api_category, method)
+
+        if race:
+            result_img = self._race_try_on(person_img_bytes, cloth_img_path, cloth_name, category, height_ratio)
+
+        # 1. Replicate (Paid, Best)
+        elif self.replicate_token and method != 'overlay':
+            try:
+                result_img = self._try_on_replicate(person_img_bytes, cloth_img_path, category)
             except Exception as e:
-                print(f"Replicate Error Traceback: {traceback.format_exc()}")
-                
-                # CRITICAL: Fallback (Gradio OOTDiffusion) ONLY supports Upper-body.
-                # If we are trying Lower-body or Dress, we CANNOT use fallback.
-                if api_category != "upper_body":
-                    print(f"⚠️ Cannot handle {api_category} with fallback. Raising error.")
-                    raise Exception(f"Replicate Failed but Fallback only supports Upper-body. Error: {str(e)}")
-
-                # Debugging: Stop fallback to see WHY Replicate is failing
-                print("⚠️ Replicate failed. Attempting Fallback to Free Model...")
-                # raise Exception(f"Replicate Error: {str(e)}") # Force UI to show error
-                
-                print("⚠️ Replicate failed. Falling back to Free Model...")
-                pass # Enable Fallback
+                self._on_replicate_error(e, api_category)
                 
         else:
              print(f"Skipping Replicate. Token: {bool(self.replicate_token)}, Method: {method}")
  
              
         # 2. Gradio (Free GenAI)
-        if method != 'overlay' and not final_result_bytes:
-            print(f"Attempting OOTDiffusion (Free GenAI) for {cloth_name} ({category})...")
-            gen_img = self._try_on_gradio(person_img_bytes, cloth_img_path, cloth_name, category, height_ratio)
-            if gen_img:
-                final_result_bytes = gen_img
+        if method != 'overlay' and result_img is None and not race:
+            result_img = self._run_gradio(person_img_bytes, cloth_img_path, cloth_name, category, height_ratio)
         elif method == 'overlay':
             print(f"Skipping GenAI due to explicit method='{method}'")
             
-        # 3. Fallback: Removed.
-        # User requested NO overlay/paste results.
-        if not final_result_bytes:
-             print("GenAI failed and Fallback is disabled.")
-             raise Exception("生成失敗：AI 模型無回應，請稍後再試。")
+        return self._finish_try_on(result_img, person_img_bytes, output_format)
+
+    async def virtual_try_on_async(self, person_img_bytes: bytes, cloth_img_path: str, cloth_name: str = "Upper-body", category: str = "Upper-body", method: str = "auto", height_ratio: float = None, output_format: str = "JPEG") -> bytes:
+        """
+        Same pipeline as virtual_try_on, for use from the event loop: the blocking SDK calls
+        and the PIL work run in worker threads, and the Replicate result is downloaded with
+        aiohttp, so one process can hold many try-ons in flight.
+        """
+        result_img = None
         
-        # 4. Post-Process: Resize back to Original Dimensions (User Request)
-        if final_result_bytes:
+        api_category = _replicate_category(category)
+        race = self._should_race(api_category, method)
+
+        if race:
+            result_img = await asyncio.to_thread(self._race_try_on, person_img_bytes, cloth_img_path, cloth_name, category, height_ratio)
+
+        # 1. Replicate (Paid, Best)
+        elif self.replicate_token and method != 'overlay':
             try:
-                from PIL import Image # Fix: Import Image locally to avoid NameError
-                # Get original size
-                with Image.open(io.BytesIO(person_img_bytes)) as orig_img:
-                    orig_w, orig_h = orig_img.size
-                    
-                with Image.open(io.BytesIO(final_result_bytes)) as res_img:
-                    # Only resize if different
-                    if res_img.size != (orig_w, orig_h):
-                        print(f"Resizing result from {res_img.size} to original {orig_w}x{orig_h}...")
-                        res_img = res_img.resize((orig_w, orig_h), Image.Resampling.LANCZOS)
-                        
-                        # Save back to bytes
-                        out = io.BytesIO()
-                        res_img.save(out, format="JPEG", quality=95)
-                        final_result_bytes = out.getvalue()
+                result_img = await self._try_on_replicate_async(person_img_bytes, cloth_img_path, category)
             except Exception as e:
-                print(f"Resize Error: {e}")
+                self._on_replicate_error(e, api_category)
+                
+        else:
+             print(f"Skipping Replicate. Token: {bool(self.replicate_token)}, Method: {method}")
 
-        # 5. Post-Process: Add Watermark (Prompt)
-        if final_result_bytes:
-            print("Adding Disclaimer Watermark...")
-            final_result_bytes = self._add_watermark(final_result_bytes)
-            
-        return final_result_bytes
+        # 2. Gradio (Free GenAI)
+        if method != 'overlay' and result_img is None and not race:
+            result_img = await asyncio.to_thread(self._run_gradio, person_img_bytes, cloth_img_path, cloth_name, category, height_ratio)
+        elif method == 'overlay':
+            print(f"Skipping GenAI due to explicit method='{method}'")
+
+        return await self.run_cpu(self._finish_try_on, result_img, person_img_bytes, output_format)
+
+    async def run_cpu(self, fn, *args, **kwargs):
+        """
+        Await `fn(*args, **kwargs)` on the dedicated PIL pool instead of the default executor.
+        """
+        return await asyncio.get_running_loop().run_in_executor(self._cpu_pool, functools.partial(fn, *args, **kwargs))
 
-    def recommend_outfit(self, height: str, weight: str, gender: str, style_preference: str, available_clothes: List[Dict]) -> List[List[Dict]]:
+    async def recommend_outfit(self, height: str, weight: str, gender: str, style_preference: str, available_clothes: List[Dict]) -> List[List[Dict]]:
         """
         根據使用者的身高、體重、性別和風格偏好推薦服裝組合。
         使用 Gemini AI 分析需求並匹配可用服裝。
@@ -838,7 +1612,8 @@ class AIService:
             print("Gemini API key not found. Using basic filter recommendation.")
             return self._basic_recommend_outfit(height, weight, gender, style_preference, available_clothes)
 
-        genai = self._get_genai_module()
+        await self._wait_for_modules()
+        genai = self.genai
         if not genai:
             print("Gemini module not available. Using basic filter recommendation.")
             return self._basic_recommend_outfit(height, weight, gender, style_preference, available_clothes)
@@ -889,57 +1664,32 @@ class AIService:
 請直接回傳 JSON，不要 markdown 格式。
 """
 
-            # 輪詢邏輯
-            errors = []
-            start_key_idx = random.randint(0, len(self.gemini_keys) - 1)
-            rotated_keys = self.gemini_keys[start_key_idx:] + self.gemini_keys[:start_key_idx]
-            
-            for key in rotated_keys:
-                genai.configure(api_key=key)
+            def parse(text):
+                result = _parse_gemini_json(text)
                 
-                for model_name in self.gemini_models:
-                    try:
-                        print(f"Trying Gemini Model: {model_name} for outfit recommendation...")
-                        model = genai.GenerativeModel(model_name)
-                        
-                        response = model.generate_content(prompt)
-                        text = response.text.replace("```json", "").replace("```", "").strip()
-                        
-                        # 找到第一個 { 和最後一個 }
-                        start = text.find("{")
-                        end = text.rfind("}") + 1
-                        if start != -1 and end != 0:
-                            text = text[start:end]
-                        
-                        result = json.loads(text)
-                        
-                        # 將 AI 回應轉換為完整的服裝項目
-                        outfits = []
-                        for outfit_ids in result.get("outfits", []):
-                            outfit_items = []
-                            for item_id in outfit_ids:
-                                cloth_id = item_id.get("id") if isinstance(item_id, dict) else str(item_id)
-                                # 找到完整的服裝項目
-                                for cloth in available_clothes:
-                                    if str(cloth.get("id", "")).replace(".jpg", "") == str(cloth_id).replace(".jpg", ""):
-                                        outfit_items.append(cloth)
-                                        break
-                            if outfit_items:  # 只有在找到至少一件服裝時才添加
-                                outfits.append(outfit_items)
-                        
-                        if outfits:
-                            print(f"AI recommended {len(outfits)} outfit combinations")
-                            return outfits
-                        else:
-                            print("AI returned empty outfits, falling back to basic recommendation")
-                            return self._basic_recommend_outfit(height, weight, gender, style_preference, available_clothes)
-
-                    except Exception as e:
-                        error_msg = str(e)
-                        key_hint = f"...{key[-4:]}"
-                        errors.append(f"Key({key_hint})/{model_name}: {error_msg}")
-                        if "404" in error_msg:
-                            continue
+                # 將 AI 回應轉換為完整的服裝項目
+                outfits = []
+                for outfit_ids in result.get("outfits", []):
+                    outfit_items = []
+                    for item_id in outfit_ids:
+                        cloth_id = item_id.get("id") if isinstance(item_id, dict) else str(item_id)
+                        # 找到完整的服裝項目
+                        for cloth in available_clothes:
+                            if str(cloth.get("id", "")).replace(".jpg", "") == str(cloth_id).replace(".jpg", ""):
+                                outfit_items.append(cloth)
+                                break
+                    if outfit_items:  # 只有在找到至少一件服裝時才添加
+                        outfits.append(outfit_items)
+                return outfits
+
+            # 輪詢邏輯
+            outfits, errors = await self._generate_with_rotation(genai, prompt, parse, " for outfit recommendation")
+            if outfits:
+                print(f"AI recommended {len(outfits)} outfit combinations")
+                return outfits
+            elif outfits is not None:
+                print("AI returned empty outfits, falling back to basic recommendation")
+                return self._basic_recommend_outfit(height, weight, gender, style_preference, available_clothes)
             
             # 如果全部失敗，使用基本推薦
             last_error = errors[-1] if errors else "Unknown Error"
@@ -949,7 +1699,6 @@ class AIService:
 
         except Exception as e:
             print(f"AI recommendation error: {e}")
-            import traceback
             traceback.print_exc()
             return self._basic_recommend_outfit(height, weight, gender, style_preference, available_clothes)
 
@@ -974,7 +1723,6 @@ class AIService:
             height_range = cloth.get("height_range", "")
             if height_range:
                 try:
-                    import re
                     nums = re.findall(r'\d+', height_range)
                     if len(nums) >= 2:
                         min_h, max_h = int(nums[0]), int(nums[1])
@@ -1,21 +1,136 @@
 import json
 import os
+import re
 from typing import List, Dict, Optional
 import time
+import hashlib
+import tempfile
+import threading
+from contextlib import contextmanager
+from functools import lru_cache
+
+import numpy as np
+
+# fcntl (POSIX) serializes JSON writes across uvicorn worker processes; Windows runs one worker
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# clothes.json is kept in git, so it stays indented unless CLOTHES_JSON_COMPACT=1
+CLOTHES_JSON_COMPACT = os.getenv("CLOTHES_JSON_COMPACT") == "1"
+
+try:
+    import orjson
+    _loads = orjson.loads
+    def _dumps(obj) -> bytes:
+        return orjson.dumps(obj, option=0 if CLOTHES_JSON_COMPACT else orjson.OPT_INDENT_2)
+except ImportError:
+    _loads = json.loads
+    def _dumps(obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, indent=None if CLOTHES_JSON_COMPACT else 4).encode('utf-8')
+
+# os.fdatasync is POSIX-only
+_fdatasync = getattr(os, "fdatasync", os.fsync)
+
+# How long a MongoDB read of the whole collection is reused
+MONGO_CACHE_TTL = 5.0
+
+def _strip_ext(cloth_id: str) -> str:
+    """
+    Item id without a trailing image extension ("012.jpg" -> "012").
+    """
+    return cloth_id.removesuffix('.jpg').removesuffix('.png')
+
+# First two numbers of a height range ("155-175cm" -> 155, 175)
+_HEIGHT_RE = re.compile(r'(\d+)(?:\D+(\d+))?')
+
+@lru_cache(maxsize=512)
+def parse_height_range(range_str: str) -> Optional[tuple]:
+    """
+    (min, max) of a height_range string; a single number "160cm" means 155-165. None if unparseable.
+    The catalog only uses a handful of distinct ranges, so results are memoized.
+    """
+    m = _HEIGHT_RE.search(range_str)
+    if not m:
+        return None
+    if m.group(2) is not None:
+        return int(m.group(1)), int(m.group(2))
+    # Maybe "160+" or "160cm"
+    n = int(m.group(1))
+    return n - 5, n + 5
+
+# Cloudinary delivery URL prefixes
+_CLOUDINARY_HOSTS = ("https://res.cloudinary.com/", "http://res.cloudinary.com/")
+# A transformation segment in a Cloudinary delivery URL, e.g. "c_limit,w_1024"
+_CLOUDINARY_TRANSFORM = re.compile(r"^[a-z]{1,3}_[^/]*$")
+
+def cloudinary_public_id(url: str) -> Optional[str]:
+    """
+    public_id of a Cloudinary delivery URL (None for other URLs):
+    https://res.cloudinary.com/<cloud>/image/upload/[<transforms>/][v123/]<folder>/<name>.jpg -> <folder>/<name>
+    """
+    if not url.startswith(_CLOUDINARY_HOSTS) or "/upload/" not in url:
+        return None
+    segments = url.split("/upload/", 1)[1].split("?", 1)[0].split("/")
+    while len(segments) > 1 and _CLOUDINARY_TRANSFORM.match(segments[0]):
+        segments.pop(0)
+    if len(segments) > 1 and segments[0][:1] == "v" and segments[0][1:].isdigit():
+        segments.pop(0)
+    folder = "/".join(segments[:-1])
+    stem = segments[-1].rpartition(".")[0] or segments[-1]
+    return f"{folder}/{stem}" if folder else stem
+
+# One MongoClient per process: warm serverless invocations reuse its pool instead of
+# rediscovering the topology and redoing the TLS handshake
+_MONGO_CLIENT = None
+
+def _get_mongo(uri: str):
+    global _MONGO_CLIENT
+    if _MONGO_CLIENT is None:
+        from pymongo import MongoClient
+        _MONGO_CLIENT = MongoClient(uri, connect=False, maxPoolSize=5,
+                                    serverSelectionTimeoutMS=2000, appname="clothing_app")
+    return _MONGO_CLIENT
 
 class ClothesManager:
+    __slots__ = ('data_file', 'use_mongo', 'client', 'db', 'collection',
+                 '_cache', '_cache_mtime', '_cache_ts', '_max_id', '_counter_seeded', '_index',
+                 '_columns', '_columns_src', '_gender_rows', '_version', '_lock', '_lock_path')
+
     def __init__(self, data_file: str):
         self.data_file = data_file
         self.use_mongo = False
+        self.client = None
         self.db = None
         self.collection = None
+
+        # Parsed clothes list, invalidated by file mtime (JSON) or TTL (MongoDB)
+        self._cache = None
+        self._cache_mtime = 0
+        self._cache_ts = 0.0
+        # Bumped whenever the list may have changed (mutation or reload), see version()
+        self._version = 0
+        # Highest numeric id in the JSON file (kept with the cache); MongoDB uses a counter doc
+        self._max_id = 0
+        self._counter_seeded = False
+        # id -> position in the JSON cache, rebuilt whenever the cache is replaced
+        self._index = {}
+        # JSON read-modify-write sections (see _json_write_lock); the lock file lives in the
+        # temp dir so it also works when the data dir is read-only
+        self._lock = threading.RLock()
+        self._lock_path = None
+        # NumPy columns (gender, height min/max) for vectorized filtering (see filter_columns)
+        self._columns = None
+        self._columns_src = None
+        # gender -> row indices of the items it matches, filled lazily per columns build (see gender_rows)
+        self._gender_rows = {}
         
         # Check for MongoDB URI
         mongo_uri = os.getenv("MONGODB_URI")
         if mongo_uri:
             try:
-                from pymongo import MongoClient
-                self.client = MongoClient(mongo_uri)
+                self.client = _get_mongo(mongo_uri)
                 self.db = self.client.get_database("clothing_app")
                 self.collection = self.db.get_collection("clothes")
                 self.use_mongo = True
@@ -24,13 +139,62 @@ class ClothesManager:
                 print(f"ClothesManager: Failed to connect to MongoDB ({e}). Falling back to local JSON.")
         
         if not self.use_mongo:
-            # Fallback for Vercel: Look in the same directory as this file
-            if not os.path.exists(self.data_file):
-                base_dir = os.path.dirname(os.path.abspath(__file__))
-                possible_path = os.path.join(base_dir, "../model/clothes.json")
-                if os.path.exists(possible_path):
-                    self.data_file = possible_path
-            self.ensure_file_exists()
+            self._init_json()
+
+    def _init_json(self):
+        # Fallback for Vercel: Look in the same directory as this file
+        if not os.path.exists(self.data_file):
+            base_dir = os.path.dirname(os.path.abspath(__file__))
+            possible_path = os.path.join(base_dir, "../model/clothes.json")
+            if os.path.exists(possible_path):
+                self.data_file = possible_path
+        self.ensure_file_exists()
+        digest = hashlib.sha1(os.path.abspath(self.data_file).encode()).hexdigest()[:16]
+        self._lock_path = os.path.join(tempfile.gettempdir(), f"clothes_{digest}.lock")
+
+    def ensure_indexes(self):
+        """
+        Create the MongoDB id index (id lookups for get/update/delete become a B-tree seek
+        instead of a collection scan). First real round trip to the server, so it runs from
+        the app's startup hook rather than __init__; an unreachable server falls back to JSON.
+        """
+        if not self.use_mongo:
+            return
+        from pymongo.errors import ConnectionFailure
+        try:
+            self.collection.create_index([("id", 1)], unique=True, background=True)
+        except ConnectionFailure as e:
+            print(f"ClothesManager: Failed to connect to MongoDB ({e}). Falling back to local JSON.")
+            self.use_mongo = False
+            self.client = self.db = self.collection = None
+            self._cache = None
+            self._index = {}
+            self._version += 1
+            self._init_json()
+        except Exception as e:
+            print(f"ClothesManager: Could not create id index ({e}).")
+
+    @contextmanager
+    def _json_write_lock(self):
+        """
+        Exclusive section for JSON read-modify-write: threads of this process via an RLock,
+        other worker processes via flock. Reads inside it see the latest file (mtime check).
+        """
+        with self._lock:
+            if fcntl is None or self._lock_path is None:
+                yield
+                return
+            try:
+                fd = os.open(self._lock_path, os.O_CREAT | os.O_RDWR, 0o644)
+            except OSError:
+                yield
+                return
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                yield
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+                os.close(fd)
 
     def ensure_file_exists(self):
         if self.use_mongo: return
@@ -52,15 +216,11 @@ class ClothesManager:
         count = -1
         try:
             if self.use_mongo and self.collection is not None:
-                count = self.collection.count_documents({})
+                # Reads collection metadata instead of scanning; may lag briefly after unclean shutdowns
+                count = self.collection.estimated_document_count()
             else:
-                 # Fallback to local list length if not using mongo or collection is None
-                 # But get_all_clothes itself might attempt mongo read
-                 # So we need to be careful.
-                 # Let's just try get_all_clothes which has fallback?
-                 # Actually get_all_clothes() has logic inside.
-                 # Let's just catch specific error.
-                 count = len(self.get_all_clothes())
+                # Length of the in-memory list; the next get_all_clothes() picks up external edits
+                count = len(self._cache) if self._cache is not None else len(self.get_all_clothes())
         except Exception as e:
             print(f"Error getting item count: {e}")
             count = -1
@@ -71,75 +231,190 @@ class ClothesManager:
             "item_count": count
         }
 
-    def get_all_clothes(self) -> List[Dict]:
+    def get_all_clothes(self, limit: Optional[int] = None, skip: int = 0, fields: Optional[List[str]] = None) -> List[Dict]:
+        """
+        All items. The returned list is the shared cache: callers that modify it
+        must persist via save_all_clothes (or the add/update/delete methods).
+        With limit/skip/fields a page of (projected) copies is returned instead; in
+        MongoDB mode that page is fetched directly with a projection and limit.
+        """
+        if limit is not None or skip or fields:
+            return self._get_page(limit, skip, fields)
+
         if self.use_mongo:
+            if self._cache is not None and time.monotonic() - self._cache_ts < MONGO_CACHE_TTL:
+                return self._cache
             try:
                 # Exclude _id from result or convert it to string
                 cursor = self.collection.find({}, {'_id': 0})
-                return list(cursor)
+                self._cache = list(cursor)
+                self._version += 1
+                self._index = {c.get('id'): i for i, c in enumerate(self._cache)}
+                self._cache_ts = time.monotonic()
+                return self._cache
             except Exception as e:
                 print(f"MongoDB Read Error: {e}")
                 return []
         
         # Local JSON Fallback
-        if not os.path.exists(self.data_file):
-            return []
+        try:
+            mtime = os.stat(self.data_file).st_mtime_ns
+        except OSError:
+            # Missing file (e.g. read-only FS): serve whatever we hold in memory
+            return self._cache if self._cache is not None else []
+
+        if self._cache is not None and mtime == self._cache_mtime:
+            return self._cache
 
         try:
-            with open(self.data_file, 'r', encoding='utf-8') as f:
-                return json.load(f)
+            with open(self.data_file, 'rb') as f:
+                self._cache = _loads(f.read())
+                self._version += 1
+            self._cache_mtime = mtime
+            self._max_id = self._scan_max_id(self._cache)
+            self._index = {c.get('id'): i for i, c in enumerate(self._cache)}
+            return self._cache
         except json.JSONDecodeError:
             print("Error decoding JSON. Returning empty list.")
             return []
 
+    def version(self) -> int:
+        """
+        Data version for response caches: re-checks the file mtime / MongoDB TTL first,
+        so a reload (e.g. a write by another worker) also counts as a change.
+        """
+        self.get_all_clothes()
+        return self._version
+
+    def _get_page(self, limit: Optional[int], skip: int, fields: Optional[List[str]]) -> List[Dict]:
+        if self.use_mongo and not (self._cache is not None and time.monotonic() - self._cache_ts < MONGO_CACHE_TTL):
+            try:
+                projection = {f: 1 for f in fields} if fields else {}
+                projection['_id'] = 0
+                cursor = self.collection.find({}, projection).skip(skip)
+                if limit is not None:
+                    cursor = cursor.limit(limit)
+                return list(cursor)
+            except Exception as e:
+                print(f"MongoDB Read Error: {e}")
+                return []
+
+        # Cached list (JSON, or a fresh MongoDB read): slice and project in memory
+        page = self.get_all_clothes()[skip:None if limit is None else skip + limit]
+        if fields:
+            return [{f: c[f] for f in fields if f in c} for c in page]
+        return [dict(c) for c in page]
+
+    def filter_columns(self):
+        """
+        (clothes, genders, hmin, hmax): the cached list plus NumPy columns of each item's
+        gender and parsed height_range bounds, rebuilt only when the list is replaced or saved.
+        Items with an unparseable range get hmin > hmax, so they never match.
+        """
+        clothes = self.get_all_clothes()
+        if self._columns is None or self._columns_src is not clothes or len(self._columns[0]) != len(clothes):
+            bounds = [parse_height_range(c.get('height_range', '')) or (1, 0) for c in clothes]
+            self._columns = (
+                np.array([c.get('gender', '') for c in clothes], dtype=str),
+                np.array([b[0] for b in bounds], dtype=np.int32),
+                np.array([b[1] for b in bounds], dtype=np.int32),
+            )
+            self._columns_src = clothes
+            self._gender_rows = {}
+        return (clothes, *self._columns)
+
+    def gender_rows(self, gender: Optional[str]):
+        """
+        (clothes, rows, hmin, hmax) like filter_columns, with `rows` the indices of the items
+        shown for `gender`: items of that gender or "中性"; "中性" alone shows only "中性" items.
+        Each gender's rows are computed once per columns build. No gender -> all rows.
+        """
+        clothes, genders, hmin, hmax = self.filter_columns()
+        if not gender:
+            return clothes, np.arange(len(clothes)), hmin, hmax
+        rows = self._gender_rows.get(gender)
+        if rows is None:
+            if gender != '中性':
+                rows = np.flatnonzero((genders == '中性') | (np.char.find(genders, gender) >= 0))
+            else:
+                rows = np.flatnonzero(genders == '中性')
+            self._gender_rows[gender] = rows
+        return clothes, rows, hmin, hmax
+
     def get_cloth_by_id(self, cloth_id: str) -> Optional[Dict]:
         if self.use_mongo:
+            # Fresh list cache: O(1) lookup through the id index, no round trip
+            if self._cache is not None and time.monotonic() - self._cache_ts < MONGO_CACHE_TTL:
+                idx = self._find_index(cloth_id)
+                if idx is not None:
+                    return self._cache[idx]
             try:
-                # Try finding by exact ID or ID without extension
-                raw_id = cloth_id.replace('.jpg', '').replace('.png', '')
-                # Note: We store "id" in doc.
-                item = self.collection.find_one({"id": raw_id}, {'_id': 0})
-                if not item:
-                     # Try fallback search if ID format mismatch
-                     item = self.collection.find_one({"id": cloth_id}, {'_id': 0})
-                return item
+                # Stored ids never carry an extension (see add_clothing_item)
+                raw_id = _strip_ext(cloth_id)
+                return self.collection.find_one({"id": raw_id}, {'_id': 0})
             except Exception as e:
                 print(f"MongoDB Find Error: {e}")
                 return None
 
+        idx = self._find_index(cloth_id)
+        return self._cache[idx] if idx is not None else None
+
+    def _find_index(self, cloth_id: str) -> Optional[int]:
+        """
+        Position of cloth_id (with or without its extension) in the JSON cache, or None.
+        """
         clothes = self.get_all_clothes()
-        for item in clothes:
-            if item['id'] == cloth_id or item['id'] == cloth_id.replace('.jpg', ''):
-                return item
+        for key in (cloth_id, _strip_ext(cloth_id)):
+            idx = self._index.get(key)
+            if idx is not None and idx < len(clothes) and clothes[idx].get('id') == key:
+                return idx
         return None
 
+    @staticmethod
+    def _scan_max_id(clothes: List[Dict]) -> int:
+        max_id = 0
+        for item in clothes:
+            curr_id_str = _strip_ext(str(item.get('id', '')))
+            if curr_id_str.isdigit():
+                max_id = max(max_id, int(curr_id_str))
+        return max_id
+
+    def _next_mongo_id(self, count: int = 1) -> int:
+        """
+        Atomically reserve `count` ids from the counters collection. Returns the last one.
+        """
+        from pymongo import ReturnDocument
+        counters = self.db.get_collection("counters")
+        if not self._counter_seeded:
+            # First use: make sure the counter is at least the highest existing id
+            existing = self.collection.find({}, {'_id': 0, 'id': 1})
+            counters.update_one({"_id": "clothes"}, {"$max": {"seq": self._scan_max_id(existing)}}, upsert=True)
+            self._counter_seeded = True
+        doc = counters.find_one_and_update({"_id": "clothes"}, {"$inc": {"seq": count}},
+                                           upsert=True, return_document=ReturnDocument.AFTER)
+        return doc["seq"]
+
+    def _next_ids(self, count: int) -> List[str]:
+        if self.use_mongo:
+            try:
+                last = self._next_mongo_id(count)
+            except Exception as e:
+                print(f"MongoDB Counter Error: {e}")
+                last = self._scan_max_id(self.get_all_clothes()) + count
+        else:
+            self.get_all_clothes()
+            last = self._max_id + count
+        return [f"{i:03d}" for i in range(last - count + 1, last + 1)]
+
     def get_next_id(self) -> str:
-        clothes = self.get_all_clothes()
-        if not clothes:
-            return "001"
-        
-        try:
-            max_id = 0
-            for item in clothes:
-                curr_id_str = str(item.get('id', '')).replace('.jpg', '').replace('.png', '')
-                if curr_id_str.isdigit():
-                    curr_id = int(curr_id_str)
-                    if curr_id > max_id:
-                        max_id = curr_id
-            
-            return f"{max_id + 1:03d}"
-        except Exception as e:
-            print(f"Error calculating next ID: {e}")
-            return f"999{int(time.time())}" # Safe fallback
+        return self._next_ids(1)[0]
 
-    def add_clothing_item(self, name: str, height_range: str, gender: str, style: str, category: str = "Upper-body", image_url: str = "") -> str:
+    def add_clothing_item(self, name: str, height_range: str, gender: str, style: str, category: str = "Upper-body", image_url: str = "", public_id: str = "") -> str:
         """
         Adds a new clothing item. Returns its ID.
+        public_id is the Cloudinary asset id (used to delete the image), if it was uploaded there.
         """
-        new_id = self.get_next_id()
-        
-        new_item = {
-            "id": new_id,
+        item = {
             "name": name,
             "height_range": height_range,
             "gender": gender,
@@ -147,20 +422,83 @@ class ClothesManager:
             "category": category,
             "image_url": image_url # Store the full URL (Cloudinary or Local)
         }
+        if public_id:
+            item["public_id"] = public_id
+        return self.add_many([item])[0]
+
+    def add_many(self, items: List[Dict]) -> List[str]:
+        """
+        Adds several clothing items in one write (one insert_many / one file save).
+        Each dict holds the add_clothing_item fields; ids are assigned here. Returns the new IDs.
+        """
+        if not items:
+            return []
+
+        def with_ids():
+            new_ids = self._next_ids(len(items))
+            new_items = [{"id": new_id, **item} for new_id, item in zip(new_ids, items)]
+            for item in new_items:
+                if not item.get("image_url"):
+                    item["image_url"] = self._default_image_url(item["id"])
+            return new_ids, new_items
         
         if self.use_mongo:
+            new_ids, new_items = with_ids()
             try:
-                self.collection.insert_one(new_item)
-                print(f"ClothesManager: Added item {new_id} to MongoDB.")
+                # insert_many adds _id to the dicts it is given; keep ours clean
+                self.collection.insert_many([dict(item) for item in new_items], ordered=False)
+                self._cache = None
+                self._version += 1
+                print(f"ClothesManager: Added item(s) {', '.join(new_ids)} to MongoDB.")
             except Exception as e:
                 print(f"MongoDB Insert Error: {e}")
                 # Fallback to local if DB fails? No, simpler to just fail or retry.
         else:
-            clothes = self.get_all_clothes()
-            clothes.append(new_item)
-            self.save_all_clothes(clothes)
+            # Id allocation and the write must not interleave with another writer
+            with self._json_write_lock():
+                new_ids, new_items = with_ids()
+                clothes = self.get_all_clothes()
+                clothes.extend(new_items)
+                self.save_all_clothes(clothes)
             
-        return new_id
+        return new_ids
+
+    @staticmethod
+    def _default_image_url(cloth_id: str) -> str:
+        # Legacy items ship as model/<id>.jpg, served under /images
+        return f"/images/{cloth_id}.jpg"
+
+    def backfill_missing_fields(self) -> int:
+        """
+        One-off migration so readers never have to derive these per request:
+        - image_url: the default local one when missing
+        - public_id: parsed once from Cloudinary image URLs
+        Returns the number of items updated.
+        """
+        with self._json_write_lock():
+            return self._backfill_missing_fields()
+
+    def _backfill_missing_fields(self) -> int:
+        clothes = self.get_all_clothes()
+        changed = []
+        for c in clothes:
+            updated = False
+            if not c.get('image_url'):
+                c['image_url'] = self._default_image_url(c['id'])
+                updated = True
+            if not c.get('public_id'):
+                public_id = cloudinary_public_id(c['image_url'])
+                if public_id:
+                    c['public_id'] = public_id
+                    updated = True
+            if updated:
+                changed.append(c)
+        if not changed:
+            return 0
+        # MongoDB: upsert just the changed items; JSON: rewrite the file once
+        self.save_all_clothes(changed if self.use_mongo else clothes)
+        print(f"ClothesManager: Backfilled fields for {len(changed)} item(s).")
+        return len(changed)
 
     def delete_clothing_item(self, cloth_id: str) -> bool:
         """
@@ -169,26 +507,24 @@ class ClothesManager:
         if self.use_mongo:
             try:
                 # Handle ID with or without extension
-                raw_id = cloth_id.replace('.jpg', '').replace('.png', '')
+                raw_id = _strip_ext(cloth_id)
                 result = self.collection.delete_one({"id": raw_id})
-                if result.deleted_count == 0:
-                     # Try fallback
-                     result = self.collection.delete_one({"id": cloth_id})
+                self._cache = None
+                self._version += 1
                 return result.deleted_count > 0
             except Exception as e:
                 print(f"MongoDB Delete Error: {e}")
                 return False
         
         # Local JSON
-        clothes = self.get_all_clothes()
-        original_len = len(clothes)
-        # Filter out the item
-        clothes = [c for c in clothes if c['id'] != cloth_id and c['id'] != cloth_id.replace('.jpg', '')]
-        
-        if len(clothes) < original_len:
+        with self._json_write_lock():
+            idx = self._find_index(cloth_id)
+            if idx is None:
+                return False
+            clothes = self._cache
+            del clothes[idx]
             self.save_all_clothes(clothes)
-            return True
-        return False
+        return True
 
     def update_clothing_item(self, cloth_id: str, updates: Dict) -> bool:
         """
@@ -196,36 +532,53 @@ class ClothesManager:
         """
         if self.use_mongo:
             try:
-                raw_id = cloth_id.replace('.jpg', '').replace('.png', '')
-                # Try update
+                raw_id = _strip_ext(cloth_id)
                 result = self.collection.update_one({"id": raw_id}, {"$set": updates})
-                if result.matched_count == 0:
-                     result = self.collection.update_one({"id": cloth_id}, {"$set": updates})
+                self._cache = None
+                self._version += 1
                 return result.matched_count > 0
             except Exception as e:
                 print(f"MongoDB Update Error: {e}")
                 return False
 
         # Local JSON
-        clothes = self.get_all_clothes()
-        found = False
-        for c in clothes:
-            if c['id'] == cloth_id or c['id'] == cloth_id.replace('.jpg', ''):
-                c.update(updates)
-                found = True
-                break
-        
-        if found:
-            self.save_all_clothes(clothes)
-        return found
+        with self._json_write_lock():
+            idx = self._find_index(cloth_id)
+            if idx is None:
+                return False
+            self._cache[idx].update(updates)
+            self.save_all_clothes(self._cache)
+        return True
 
     def save_all_clothes(self, clothes_list: List[Dict]):
         if self.use_mongo:
-            print("Warning: Bulk save not implemented for MongoDB mode.")
+            # Upsert every item in a single round-trip; items not in the list are left alone
+            from pymongo import ReplaceOne
+            try:
+                ops = [ReplaceOne({"id": item["id"]}, {k: v for k, v in item.items() if k != '_id'}, upsert=True)
+                       for item in clothes_list]
+                if ops:
+                    self.collection.bulk_write(ops, ordered=False)
+                self._cache = None
+                self._version += 1
+            except Exception as e:
+                print(f"MongoDB Bulk Write Error: {e}")
             return
 
+        # Keep serving the new list even if the write below fails (read-only FS)
+        self._cache = clothes_list
+        self._version += 1
+        self._max_id = self._scan_max_id(clothes_list)
+        self._index = {c.get('id'): i for i, c in enumerate(clothes_list)}
+        self._columns = None
         try:
-            with open(self.data_file, 'w', encoding='utf-8') as f:
-                json.dump(clothes_list, f, ensure_ascii=False, indent=4)
+            # Write a temp file and rename it over the old one, so a crash never leaves half a JSON file
+            tmp = self.data_file + '.tmp'
+            with open(tmp, 'wb') as f:
+                f.write(_dumps(clothes_list))
+                f.flush()
+                _fdatasync(f.fileno())
+            os.replace(tmp, self.data_file)
+            self._cache_mtime = os.stat(self.data_file).st_mtime_ns
         except OSError as e:
             print(f"Failed to save data file (Read-Only FS?): {e}")
@@ -1,14 +1,35 @@
 from dotenv import load_dotenv
 load_dotenv()
 
-from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Request
-from fastapi.staticfiles import StaticFiles
+from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Request, BackgroundTasks, Depends
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, JSONResponse, Response
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
 from typing import Optional, List
 import shutil
-import shutil
 import os
+import io
+import sys
+import time
+import importlib
+import importlib.util
+import hashlib
+import asyncio
+import tempfile
+from collections import deque, OrderedDict
+from functools import lru_cache
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+import orjson
+
+# Cloudinary (optional): imported once here instead of on every upload
+try:
+    import cloudinary
+    import cloudinary.uploader
+    import cloudinary.utils
+except ImportError:
+    cloudinary = None
 
 # Serverless/Vercel Fix: Force cache directories to /tmp
 os.environ['HF_HOME'] = '/tmp/hf'
@@ -21,12 +42,41 @@ from backend.clothes_manager import ClothesManager
 from backend.ai_service import AIService
 from pydantic import BaseModel
 
-app = FastAPI()
+# Threads behind asyncio.to_thread (SDK calls, PIL work, file I/O); the default pool
+# is min(32, cpu + 4), too small when many try-ons wait on remote models at once
+DEFAULT_EXECUTOR_THREADS = int(os.getenv("DEFAULT_EXECUTOR_THREADS", "64"))
+
+# Shared async HTTP client for garment downloads: keep-alive reuses the TLS connection to Cloudinary
+HTTP_TIMEOUT = 10.0
+_http: Optional[httpx.AsyncClient] = None
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global _http
+    executor = ThreadPoolExecutor(max_workers=DEFAULT_EXECUTOR_THREADS)
+    asyncio.get_running_loop().set_default_executor(executor)
+    _http = httpx.AsyncClient(timeout=HTTP_TIMEOUT, follow_redirects=True,
+                              limits=httpx.Limits(max_keepalive_connections=32))
+    if clothes_manager is not None:
+        await asyncio.to_thread(clothes_manager.ensure_indexes)
+    yield
+    await _http.aclose()
+    executor.shutdown(wait=False)
+
+class ORJSONResponse(JSONResponse):
+    """
+    JSONResponse rendered with orjson: several times faster than stdlib json on the
+    dict-heavy responses, and it produces bytes directly (FastAPI's own ORJSONResponse is deprecated).
+    """
+    def render(self, content) -> bytes:
+        return orjson.dumps(content)
+
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
 
 # Global Exception Handler
 @app.exception_handler(Exception)
 async def global_exception_handler(request: Request, exc: Exception):
-    return JSONResponse(
+    return ORJSONResponse(
         status_code=500,
         content={"message": "Internal Server Error", "detail": str(exc)},
     )
@@ -43,21 +93,215 @@ app.add_middleware(
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 MODEL_DIR = os.path.join(BASE_DIR, "model")
 DATA_FILE = os.path.join(MODEL_DIR, "clothes.json")
+# Fields the clothes list endpoint returns when paginating
+LIST_FIELDS = ["id", "name", "category", "gender", "style", "height_range", "image_url"]
+# Serialized /api/clothes responses per normalized query: (etag, body), all built from data
+# version _LIST_CACHE_VERSION; the whole cache is dropped when ClothesManager.version() moves on
+# (writes here, or reloads of outside edits). LRU-capped: the key space comes from query strings
+LIST_CACHE_SIZE = 256
+_LIST_CACHE = OrderedDict()
+_LIST_CACHE_VERSION = None
+# Accepted ?gender= values
+GENDERS = ("男性", "女性", "中性")
+
+# Largest accepted photo upload; bigger files get a 413 instead of being read into memory
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(15 * 1024 * 1024)))
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# Uploads above this size are spooled to disk instead of memory
+UPLOAD_SPOOL_MAX = 1024 * 1024
+
+# Cap on concurrent Cloudinary uploads (each holds a worker thread and a connection),
+# with exponential backoff between retries when Cloudinary errors or throttles
+CLOUDINARY_MAX_CONCURRENCY = int(os.getenv("CLOUDINARY_MAX_CONCURRENCY", "16"))
+CLOUDINARY_RETRIES = 3
+CLOUDINARY_FOLDER = "clothing_app"
+# Uploads bigger than this go through upload_large in chunks of this size
+CLOUDINARY_CHUNK_SIZE = 6_000_000
+_CLOUD_SEM = asyncio.Semaphore(CLOUDINARY_MAX_CONCURRENCY)
+
+async def run_cloudinary_upload_limited(upload_fn):
+    """
+    Run the blocking `upload_fn` in a thread under _CLOUD_SEM, retrying after 1s, 2s, ...
+    """
+    async with _CLOUD_SEM:
+        for attempt in range(CLOUDINARY_RETRIES):
+            try:
+                return await asyncio.to_thread(upload_fn)
+            except Exception as e:
+                if attempt == CLOUDINARY_RETRIES - 1:
+                    raise
+                delay = 2 ** attempt
+                print(f"Cloudinary upload attempt {attempt + 1} failed ({e}); retrying in {delay}s")
+                await asyncio.sleep(delay)
+
+# Generated images are sent in slices of this size
+IMAGE_CHUNK_SIZE = 64 * 1024
+
+def image_response(data: bytes, media_type: str, headers: Optional[dict] = None) -> StreamingResponse:
+    """
+    Stream an in-memory image as zero-copy memoryview slices, keeping Content-Length.
+    """
+    view = memoryview(data)
+    chunks = (view[i:i + IMAGE_CHUNK_SIZE] for i in range(0, len(view), IMAGE_CHUNK_SIZE))
+    return StreamingResponse(chunks, media_type=media_type,
+                             headers={**(headers or {}), "Content-Length": str(len(data))})
+
+async def read_upload(file: UploadFile, limit: int = MAX_UPLOAD_BYTES) -> bytes:
+    """
+    Read an upload, rejecting it with 413 once it exceeds `limit`.
+    """
+    # The multipart parser already knows the size: check it, then read once into a single
+    # bytes object (no growing buffer plus final copy)
+    if file.size is not None:
+        if file.size > limit:
+            raise HTTPException(status_code=413, detail=f"File too large (max {limit // (1024 * 1024)} MB)")
+        try:
+            return await file.read()
+        finally:
+            # Drop the parser's spooled copy now rather than when the request ends
+            await file.close()
+
+    buf = bytearray()
+    while True:
+        chunk = await file.read(UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            return bytes(buf)
+        buf += chunk
+        if len(buf) > limit:
+            raise HTTPException(status_code=413, detail=f"File too large (max {limit // (1024 * 1024)} MB)")
+
+async def spool_upload(file: UploadFile, limit: int = MAX_UPLOAD_BYTES):
+    """
+    (file object, size) for the upload, rewound and seekable, rejecting it with 413 once it exceeds `limit`.
+    Small uploads stay in memory, large ones on disk; nothing is materialized as one bytes object.
+    """
+    if file.size is not None:
+        if file.size > limit:
+            raise HTTPException(status_code=413, detail=f"File too large (max {limit // (1024 * 1024)} MB)")
+        # The multipart parser already spooled it
+        await file.seek(0)
+        return file.file, file.size
+
+    spool = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_MAX)
+    size = 0
+    while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+        size += len(chunk)
+        if size > limit:
+            spool.close()
+            raise HTTPException(status_code=413, detail=f"File too large (max {limit // (1024 * 1024)} MB)")
+        spool.write(chunk)
+    spool.seek(0)
+    return spool, size
+
+def copy_to_file(path: str, src):
+    src.seek(0)
+    with open(path, "wb") as f:
+        shutil.copyfileobj(src, f, UPLOAD_CHUNK_SIZE)
+        if hasattr(os, "posix_fadvise"):
+            # Written once, served rarely: don't let it push clothes.json out of the page cache
+            f.flush()
+            os.fdatasync(f.fileno())
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+async def download_to_temp(url: str, path: str) -> bool:
+    """
+    Stream `url` into `path` (via a temp file, renamed into place) over the shared client.
+    False (logged) if the download fails.
+    """
+    print(f"Downloading cloth image from {url}...")
+    fd, tmp_path = tempfile.mkstemp(suffix=".jpg", dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            async with _http.stream("GET", url) as response:
+                if response.status_code != 200:
+                    print(f"Failed to download image: {response.status_code}")
+                    return False
+                async for chunk in response.aiter_bytes(65536):
+                    f.write(chunk)
+        os.replace(tmp_path, path)
+        tmp_path = None
+    except Exception as e:
+        print(f"Download error: {e}")
+        return False
+    finally:
+        # Any exit short of the rename (failure, or cancellation) drops the partial file
+        if tmp_path is not None:
+            os.remove(tmp_path)
+    print(f"Downloaded to: {path}")
+    return True
+
+# Garment images downloaded for try-on, reused for CLOTH_DOWNLOAD_TTL seconds (by URL)
+CLOTH_DOWNLOAD_DIR = os.path.join(tempfile.gettempdir(), "cloth_downloads")
+CLOTH_DOWNLOAD_TTL = int(os.getenv("CLOTH_DOWNLOAD_TTL", "600"))
+# url -> Future of the download in progress, so concurrent try-ons share one fetch
+_CLOTH_DOWNLOADS = {}
+
+async def fetch_cloth_image(url: str) -> Optional[str]:
+    """
+    Local path of the garment at `url`, or None if it can't be downloaded.
+    A recent copy is reused; concurrent callers for the same URL await a single download.
+    """
+    path = os.path.join(CLOTH_DOWNLOAD_DIR, hashlib.sha1(url.encode()).hexdigest() + ".jpg")
+    try:
+        if time.time() - os.stat(path).st_mtime < CLOTH_DOWNLOAD_TTL:
+            return path
+    except FileNotFoundError:
+        pass
+
+    future = _CLOTH_DOWNLOADS.get(url)
+    if future is None:
+        # Single event loop thread: no lock needed between the lookup and the insert
+        future = asyncio.ensure_future(_download_cloth(url, path))
+        _CLOTH_DOWNLOADS[url] = future
+        future.add_done_callback(lambda _: _CLOTH_DOWNLOADS.pop(url, None))
+    # shield: one caller disconnecting doesn't cancel the download for the others
+    return await asyncio.shield(future)
+
+async def _download_cloth(url: str, path: str) -> Optional[str]:
+    os.makedirs(CLOTH_DOWNLOAD_DIR, exist_ok=True)
+    return path if await download_to_temp(url, path) else None
 
 # Debug Endpoint
+# /api/debug lists files and env keys: only served when DEBUG_ENDPOINT is set
+DEBUG_ENDPOINT = bool(os.getenv("DEBUG_ENDPOINT"))
+DEBUG_FILE_LIMIT = 50
+
+# Listing depth below BASE_DIR, and how long (s) one listing is reused
+DEBUG_MAX_DEPTH = 2
+DEBUG_FILES_TTL = 10
+
+@lru_cache(maxsize=1)
+def list_debug_files(ttl_bucket: int) -> List[str]:
+    """
+    Up to DEBUG_FILE_LIMIT files under BASE_DIR, at most DEBUG_MAX_DEPTH levels deep.
+    `ttl_bucket` is the cache key: repeated probes within DEBUG_FILES_TTL seconds reuse the listing.
+    """
+    # Breadth-first scandir that stops at DEBUG_FILE_LIMIT files instead of walking the whole tree
+    files = []
+    pending = deque([(BASE_DIR, 0)])
+    while pending and len(files) < DEBUG_FILE_LIMIT:
+        path, depth = pending.popleft()
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if depth < DEBUG_MAX_DEPTH:
+                        pending.append((entry.path, depth + 1))
+                elif len(files) < DEBUG_FILE_LIMIT:
+                    files.append(os.path.relpath(entry.path, BASE_DIR))
+    return files
+
 @app.get("/api/debug")
 async def debug_info():
+    if not DEBUG_ENDPOINT:
+        raise HTTPException(status_code=404, detail="Not Found")
     try:
-        files = []
-        for root, dirs, filenames in os.walk(BASE_DIR):
-            for filename in filenames:
-                files.append(os.path.relpath(os.path.join(root, filename), BASE_DIR))
+        files = list_debug_files(int(time.time() // DEBUG_FILES_TTL))
         return {
             "base_dir": BASE_DIR,
             "model_dir": MODEL_DIR,
             "data_file": DATA_FILE,
             "exists": os.path.exists(DATA_FILE),
-            "files": files[:50], # Limit output
+            "files": files,
             "env": {k: "***" for k in os.environ.keys()} # List env keys only
         }
     except Exception as e:
@@ -89,8 +333,27 @@ async def health_check():
 clothes_manager = None
 ai_service = None
 
+def require_clothes_manager():
+    """
+    Route dependency: 503 while ClothesManager is unavailable (init failed), so handlers can use it unchecked.
+    """
+    if clothes_manager is None:
+        raise HTTPException(status_code=503, detail="ClothesManager failed to initialize")
+
+def require_ai_service():
+    """
+    Route dependency: 503 while AIService is unavailable (init failed).
+    """
+    if ai_service is None:
+        raise HTTPException(status_code=503, detail="AIService failed to initialize")
+
+NEEDS_CLOTHES = [Depends(require_clothes_manager)]
+NEEDS_AI = [Depends(require_ai_service)]
+NEEDS_BOTH = NEEDS_CLOTHES + NEEDS_AI
+
 try:
     clothes_manager = ClothesManager(DATA_FILE)
+    clothes_manager.backfill_missing_fields()
 except Exception as e:
     print(f"Failed to init ClothesManager: {e}")
 
@@ -99,124 +362,210 @@ try:
 except Exception as e:
     print(f"Failed to init AIService: {e}")
 
-# Mount static files for accessing images
-try:
-    if os.path.exists(MODEL_DIR):
-        app.mount("/images", StaticFiles(directory=MODEL_DIR), name="images")
-    else:
-        print(f"Warning: Model dir {MODEL_DIR} not found. Images will not load.")
-except Exception as e:
-    print(f"Failed to mount static files: {e}")
-
-@app.get("/api/clothes")
-async def get_clothes(gender: Optional[str] = None, height: Optional[str] = None):
+# Cloudinary reads CLOUDINARY_URL on first config(); do it once here rather than in a request.
+# CLOUDINARY_ENABLED is resolved once; request handlers only test the flag.
+CLOUDINARY_ENABLED = False
+if cloudinary is not None and os.getenv("CLOUDINARY_URL"):
+    try:
+        cloudinary.config(secure=True)
+        # The SDK's shared urllib3 pool keeps only 1 connection per host, so concurrent
+        # uploads/deletes redo the TLS handshake; size it to our upload concurrency
+        if hasattr(cloudinary.uploader, "_http") and hasattr(cloudinary.utils, "get_http_connector"):
+            cloudinary.uploader._http = cloudinary.utils.get_http_connector(
+                cloudinary.config(),
+                {**getattr(cloudinary, "CERT_KWARGS", {}), "maxsize": CLOUDINARY_MAX_CONCURRENCY},
+            )
+        CLOUDINARY_ENABLED = bool(cloudinary.config().cloud_name)
+    except Exception as e:
+        print(f"Failed to configure Cloudinary: {e}")
+
+# Serve images with FileResponse: Starlette hands the path to the server (pathsend/sendfile)
+# when it supports it, instead of streaming the file through Python
+IMAGE_CACHE_CONTROL = "public, max-age=3600"
+MODEL_DIR_REAL = os.path.realpath(MODEL_DIR)
+MODEL_DIR_EXISTS = os.path.isdir(MODEL_DIR)
+
+if not MODEL_DIR_EXISTS:
+    print(f"Warning: Model dir {MODEL_DIR} not found. Images will not load.")
+
+@app.api_route("/images/{name:path}", methods=["GET", "HEAD"])
+async def get_image(name: str, request: Request):
+    if not MODEL_DIR_EXISTS:
+        raise HTTPException(status_code=404, detail="Not Found")
+    path = os.path.realpath(os.path.join(MODEL_DIR_REAL, name))
+    if not path.startswith(MODEL_DIR_REAL + os.sep):
+        raise HTTPException(status_code=404, detail="Not Found")
+    try:
+        st = os.stat(path)
+    except OSError:
+        raise HTTPException(status_code=404, detail="Not Found")
+
+    response = FileResponse(path, stat_result=st, headers={"Cache-Control": IMAGE_CACHE_CONTROL})
+    etag = response.headers["etag"]
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": IMAGE_CACHE_CONTROL})
+    return response
+
+@app.get("/api/clothes", dependencies=NEEDS_CLOTHES)
+async def get_clothes(request: Request, gender: Optional[str] = None, height: Optional[str] = None,
+                      limit: Optional[int] = None, offset: int = 0):
     """
     Get list of clothes. Optional filters for gender and height.
+    Optional limit/offset paginate the (filtered) list; without them every item is returned.
+    Responses carry an ETag; a matching If-None-Match gets a 304.
     """
-    if not clothes_manager:
-        raise HTTPException(status_code=500, detail="ClothesManager failed to initialize")
-        
-    try:
+    if gender and gender not in GENDERS:
+        raise HTTPException(status_code=400, detail=f"gender must be one of {', '.join(GENDERS)}")
+    if limit is not None and limit < 0 or offset < 0:
+        raise HTTPException(status_code=400, detail="limit and offset must be >= 0")
+    # Normalize so equivalent queries share an entry: any non-numeric height matches nothing
+    if height:
+        try:
+            height = str(int(height))
+        except ValueError:
+            height = "invalid"
+
+    # Debugging: Expose storage mode in header
+    mode = "MongoDB" if clothes_manager.use_mongo else "Local-JSON"
+    cache_key = (gender or None, height or None, limit, offset)
+    global _LIST_CACHE_VERSION
+    version = clothes_manager.version()
+    if version != _LIST_CACHE_VERSION:
+        _LIST_CACHE.clear()
+        _LIST_CACHE_VERSION = version
+    cached = _LIST_CACHE.get(cache_key)
+    if cached is not None:
+        _LIST_CACHE.move_to_end(cache_key)
+    else:
+        try:
+            body = orjson.dumps(build_clothes_list(gender, height, limit, offset))
+        except Exception as e:
+            print(f"Error in get_clothes: {e}")
+            import traceback
+            traceback.print_exc()
+            raise HTTPException(status_code=500, detail=f"Failed to list clothes: {e}")
+        cached = ('"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"', body)
+        _LIST_CACHE[cache_key] = cached
+        if len(_LIST_CACHE) > LIST_CACHE_SIZE:
+            _LIST_CACHE.popitem(last=False)
+
+    etag, body = cached
+    headers = {"ETag": etag, "Cache-Control": "no-cache", "X-Storage-Mode": mode}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+def build_clothes_list(gender: Optional[str], height: Optional[str], limit: Optional[int], offset: int) -> List[dict]:
+    paginate = limit is not None or offset > 0
+    if paginate and not (gender or height):
+        # No filters: let the manager fetch only the requested page and list fields
+        all_clothes = clothes_manager.get_all_clothes(limit=limit, skip=offset, fields=LIST_FIELDS)
+    else:
         all_clothes = clothes_manager.get_all_clothes()
-        
-        # Filter logic
-        filtered = all_clothes
-        if gender:
-            # "中性" matches "女性"? Debatable. 
-            # Current logic: if "女性", we want items marked "女性" or "中性"?
-            # User Input: "女性" -> returns items with gender="女性" or "中性" (maybe?)
-            # Or if item is "中性", it matches everyone.
-            # Let's adjust: Item matches if item.gender == '中性' OR item.gender == user_gender
-            if gender != '中性':
-                filtered = [c for c in filtered if c['gender'] == '中性' or gender in c['gender']]
-            else:
-                 # Users selecting "中性" might want everything or just neutral?
-                 # Usually users select their OWN gender.
-                 # If user says "中性", they see "中性" items.
-                 filtered = [c for c in filtered if c['gender'] == '中性']
-        
-
+    
+    # Filter logic: the manager's precomputed gender rows, then a vectorized height check on just those
+    filtered = all_clothes
+    if gender or height:
+        clothes, rows, hmin, hmax = clothes_manager.gender_rows(gender)
         if height:
-            # Range Logic: Parse "155-175"
-            def is_in_range(user_h, range_str):
-                try:
-                    # Extract numbers
-                    import re
-                    nums = re.findall(r'\d+', range_str)
-                    if len(nums) >= 2:
-                        min_h, max_h = int(nums[0]), int(nums[1])
-                        return min_h <= int(user_h) <= max_h
-                    if len(nums) == 1:
-                        # Maybe "160+" or "160cm"
-                        return int(nums[0]) - 5 <= int(user_h) <= int(nums[0]) + 5
-                    return False
-                except:
-                    return False
-
-            filtered = [c for c in filtered if is_in_range(height, c.get('height_range', ''))]
-            
-
-            
-        # Add image URL to response
-        for c in filtered:
-            if 'image_url' not in c or not c['image_url']:
-                c['image_url'] = f"/images/{c['id']}.jpg"
-
-        # Debugging: Expose storage mode in header
-        mode = "MongoDB" if clothes_manager.use_mongo else "Local-JSON"
-        return JSONResponse(content=filtered, headers={"X-Storage-Mode": mode})
-    except Exception as e:
-        print(f"Error in get_clothes: {e}")
-        import traceback
-        traceback.print_exc()
-        return []
-        raise HTTPException(status_code=500, detail=str(e))
+            # Range Logic: "155-175" parsed once per item into hmin/hmax
+            try:
+                user_h = int(height)
+                rows = rows[(hmin[rows] <= user_h) & (user_h <= hmax[rows])]
+            except ValueError:
+                rows = rows[:0]
+        # Paginate the matching indices, then materialize only that page in one pass
+        if paginate:
+            rows = rows[offset:None if limit is None else offset + limit]
+        filtered = [clothes[i] for i in rows]
+
+    # image_url is always set (ClothesManager.backfill_missing_fields / add_many)
+    return filtered
+
+# Import checks for /api/debug-status: a module's status doesn't change while the process runs
+_IMPORT_STATUS = {}
+
+def import_status(module: str, version: bool = False) -> str:
+    """
+    "ok" / "ok (<version>)" / "fail: ..." for `module`, resolved once. find_spec answers
+    "missing" without importing; the real import (e.g. Gradio's heavy one) happens at most once.
+    """
+    status = _IMPORT_STATUS.get(module)
+    if status is None:
+        try:
+            if importlib.util.find_spec(module) is None:
+                status = f"fail: No module named '{module}'"
+            else:
+                mod = importlib.import_module(module)
+                status = f"ok ({mod.__version__})" if version else "ok"
+        except Exception as e:
+            status = f"fail: {str(e)}"
+        _IMPORT_STATUS[module] = status
+    return status
 
 @app.get("/api/debug-status")
 async def debug_status():
     """
     Diagnostic endpoint to check environment health.
     """
-    import tempfile
-    import os
-    import sys
-    
     status = {
         "python_version": sys.version,
         "temp_dir": tempfile.gettempdir(),
         "hf_home": os.environ.get("HF_HOME"),
         "gradio_temp": os.environ.get("GRADIO_TEMP_DIR"),
         "write_test": "pending",
-        "gradio_import": "pending",
-        "cloudinary_import": "pending"
+        "gradio_import": import_status("gradio_client", version=True),
+        "cloudinary_import": import_status("cloudinary")
     }
     
-    # 1. Test Write
+    # Test Write (raw fd: no file object / NamedTemporaryFile bookkeeping)
     try:
-        with tempfile.NamedTemporaryFile(delete=True) as f:
-            f.write(b"test")
+        path = os.path.join(tempfile.gettempdir(), f"debug_status_{os.getpid()}")
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            os.write(fd, b"test")
+        finally:
+            os.close(fd)
+            os.unlink(path)
         status["write_test"] = "ok"
     except Exception as e:
         status["write_test"] = f"fail: {str(e)}"
         
-    # 2. Test Import
-    try:
-        import gradio_client
-        status["gradio_import"] = f"ok ({gradio_client.__version__})"
-    except Exception as e:
-        status["gradio_import"] = f"fail: {str(e)}"
-
-    # 3. Test Cloudinary
-    try:
-        import cloudinary
-        status["cloudinary_import"] = "ok"
-    except Exception as e:
-        status["cloudinary_import"] = f"fail: {str(e)}"
-        
     return status
 
-@app.post("/api/upload")
+# Name shown for an uploaded item until its AI analysis finishes
+PENDING_NAME = "分析中"
+
+async def analyze_in_background(cloth_id: str, content: Optional[bytes], category: str, prep_cloth: bool = True):
+    """
+    Post-response work for a new upload: AI name/style analysis and the VTON garment prep
+    (so later try-ons skip trim/resize), then store the analysis on the item.
+    Without `content` (image unavailable) the item just gets the default name/style.
+    `prep_cloth=False` skips the prep when `content` isn't the exact file try-on will fetch.
+    """
+    async def run_cloth_prep():
+        try:
+            await ai_service.prepare_cloth_asset_async(content, category=category)
+        except Exception as e:
+            print(f"Cloth asset prep failed: {e}")
+
+    if content is None:
+        analysis_result = {}
+    else:
+        analysis_result, *_ = await asyncio.gather(ai_service.analyze_image_style(content),
+                                                   *([run_cloth_prep()] if prep_cloth else []),
+                                                   return_exceptions=True)
+    if isinstance(analysis_result, Exception):
+        print(f"AI Analysis Failed: {analysis_result}")
+        analysis_result = {}
+
+    updates = {"name": analysis_result.get("name", "未命名"), "style": analysis_result.get("style", "一般")}
+    await asyncio.to_thread(clothes_manager.update_clothing_item, cloth_id, updates)
+    print(f"Background analysis stored for {cloth_id}: {updates}")
+
+@app.post("/api/upload", dependencies=NEEDS_BOTH)
 async def upload_clothing(
+    background_tasks: BackgroundTasks,
     file: UploadFile = File(...),
     height_range: str = Form(...),
     gender: str = Form(...),
@@ -224,53 +573,43 @@ async def upload_clothing(
 ):
     """
     Upload a clothing image.
-    Optimized: Runs AI Analysis and Cloudinary Upload in PARALLEL.
+    The item is stored right away with a provisional name ("status": "pending");
+    AI analysis and cloth prep run after the response (see analyze_in_background).
     """
     try:
-        # Read file content
-        content = await file.read()
+        # Spooled upload: handed to Cloudinary / copied to disk as a file object
+        spool, size = await spool_upload(file)
+        # The analysis needs the image in memory anyway: read it once, up front, so the
+        # Cloudinary attempts below never touch the spool (upload_large closes its file)
+        spool.seek(0)
+        content = await asyncio.to_thread(spool.read)
         
         # Define wrapper functions for blocking calls
-        def run_ai_analysis():
-            return ai_service.analyze_image_style(content)
-            
         def run_cloudinary_upload():
-            cloudinary_url = os.getenv("CLOUDINARY_URL")
-            if not cloudinary_url:
-                return None, False
-                
-            try:
-                import cloudinary
-                import cloudinary.uploader
-                import io
-                
-                print("Uploading to Cloudinary (Thread)...")
-                file_obj = io.BytesIO(content)
-                file_obj.name = "upload.jpg" 
+            if not CLOUDINARY_ENABLED:
+                return None, None, False
                 
-                response = cloudinary.uploader.upload(file_obj, folder="clothing_app")
-                url = response.get("secure_url")
-                print(f"Cloudinary Upload Success: {url}")
-                return url, True
-            except Exception as e:
-                print(f"Cloudinary Upload Failed: {e}")
-                return None, False
+            print("Uploading to Cloudinary (Thread)...")
+            # Fresh handle per attempt, so a retry doesn't get a closed or half-read file
+            file_obj = io.BytesIO(content)
+            file_obj.name = "upload.jpg"
+            
+            if size > CLOUDINARY_CHUNK_SIZE:
+                # Chunked upload: a dropped connection only costs the current chunk
+                response = cloudinary.uploader.upload_large(file_obj, chunk_size=CLOUDINARY_CHUNK_SIZE,
+                                                            folder=CLOUDINARY_FOLDER, resource_type="image")
+            else:
+                response = cloudinary.uploader.upload(file_obj, folder=CLOUDINARY_FOLDER)
+            url = response.get("secure_url")
+            print(f"Cloudinary Upload Success: {url}")
+            return url, response.get("public_id"), True
 
-        # Execute in parallel using threads (since these libs are blocking)
-        import asyncio
-        
-        # Create tasks
-        ai_task = asyncio.to_thread(run_ai_analysis)
-        upload_task = asyncio.to_thread(run_cloudinary_upload)
-        
-        # Await both
-        print("Starting Parallel Tasks: AI + Upload")
-        analysis_result, (cloud_url, uploaded_to_cloud) = await asyncio.gather(ai_task, upload_task)
-        print("Parallel Tasks Completed")
-        
-        # Process Results
-        name = analysis_result.get("name", "未命名")
-        style = analysis_result.get("style", "一般")
+        try:
+            cloud_url, public_id, uploaded_to_cloud = await run_cloudinary_upload_limited(run_cloudinary_upload)
+        except Exception as e:
+            # Same as no Cloudinary: fall through to local storage
+            print(f"Cloudinary Upload Failed: {e}")
+            cloud_url, public_id, uploaded_to_cloud = None, None, False
         
         image_url = ""
         
@@ -287,8 +626,8 @@ async def upload_clothing(
                 
                 # Simple check to avoid crash on Read-Only FS
                 try:
-                    with open(file_path, "wb") as f:
-                        f.write(content)
+                    # Write in a worker thread so the event loop doesn't stall on disk I/O
+                    await asyncio.to_thread(copy_to_file, file_path, spool)
                     image_url = f"/images/{filename}"
                 except OSError:
                      # If we really can't save (Read-only Vercel + No Cloudinary), we are in trouble.
@@ -308,54 +647,147 @@ async def upload_clothing(
              pass
 
         # Add to database
-        new_id = clothes_manager.add_clothing_item(name, height_range, gender, style, category=category, image_url=image_url)
+        # Locked, fsync'd write: keep it off the event loop
+        new_id = await asyncio.to_thread(clothes_manager.add_clothing_item, PENDING_NAME, height_range, gender, "",
+                                         category=category, image_url=image_url,
+                                         public_id=(public_id or "") if image_url == cloud_url else "")
+        background_tasks.add_task(analyze_in_background, new_id, content, category)
         
         return {
             "id": new_id,
-            "name": name,
-            "style": style,
-            "image_url": image_url
+            "name": PENDING_NAME,
+            "style": "",
+            "image_url": image_url,
+            "status": "pending"
         }
         
+    except HTTPException as he:
+        raise he
     except Exception as e:
         print(f"Error processing upload: {e}")
         import traceback
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/api/validate-avatar")
+# Direct browser -> Cloudinary uploads: the backend only signs the request and
+# records the result, so the image bytes never pass through this server
+# Cloudinary transformation for the copy the backend analyzes (fit within 1024px)
+COMMIT_ANALYSIS_TRANSFORM = "c_limit,w_1024,h_1024"
+
+@app.get("/api/upload/sign")
+async def sign_upload():
+    """
+    Signed parameters for a direct upload to Cloudinary. 404 when Cloudinary isn't configured
+    (clients then fall back to POST /api/upload).
+    """
+    if not CLOUDINARY_ENABLED:
+        raise HTTPException(status_code=404, detail="Direct upload is not available")
+
+    cfg = cloudinary.config()
+    params = {"timestamp": int(time.time()), "folder": CLOUDINARY_FOLDER}
+    return {
+        **params,
+        "signature": cloudinary.utils.api_sign_request(params, cfg.api_secret),
+        "api_key": cfg.api_key,
+        "cloud_name": cfg.cloud_name,
+        "upload_url": f"https://api.cloudinary.com/v1_1/{cfg.cloud_name}/image/upload",
+    }
+
+class CommitUploadRequest(BaseModel):
+    secure_url: str
+    public_id: str
+    height_range: str
+    gender: str
+    category: str = "Upper-body"
+
+@app.post("/api/upload/commit", dependencies=NEEDS_BOTH)
+async def commit_upload(commit: CommitUploadRequest, background_tasks: BackgroundTasks):
+    """
+    Record an image the browser uploaded straight to Cloudinary (see /api/upload/sign).
+    Like /api/upload, the AI analysis (of a downsized copy) runs after the response. No cloth
+    prep here: its cache is keyed by the image bytes, and try-on fetches the original.
+    """
+    if not CLOUDINARY_ENABLED:
+        raise HTTPException(status_code=404, detail="Direct upload is not available")
+
+    # Only accept images from our own Cloudinary account
+    prefix = f"https://res.cloudinary.com/{cloudinary.config().cloud_name}/image/upload/"
+    if not commit.secure_url.startswith(prefix):
+        raise HTTPException(status_code=400, detail="Image must be uploaded to this app's Cloudinary account")
+
+    try:
+        analysis_url = prefix + COMMIT_ANALYSIS_TRANSFORM + "/" + commit.secure_url[len(prefix):]
+
+        new_id = await asyncio.to_thread(clothes_manager.add_clothing_item, PENDING_NAME, commit.height_range,
+                                         commit.gender, "", category=commit.category,
+                                         image_url=commit.secure_url, public_id=commit.public_id)
+
+        async def analyze_uploaded():
+            try:
+                # Shared keep-alive client: no per-upload TLS handshake with Cloudinary's CDN
+                res = await _http.get(analysis_url, timeout=30)
+                res.raise_for_status()
+                content = res.content
+            except Exception as e:
+                print(f"Fetching uploaded image failed: {e}")
+                content = None
+            await analyze_in_background(new_id, content, commit.category, prep_cloth=False)
+
+        background_tasks.add_task(analyze_uploaded)
+
+        return {
+            "id": new_id,
+            "name": PENDING_NAME,
+            "style": "",
+            "image_url": commit.secure_url,
+            "status": "pending"
+        }
+
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        print(f"Error committing upload: {e}")
+        import traceback
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/api/validate-avatar", dependencies=NEEDS_AI)
 async def validate_avatar(file: UploadFile = File(...)):
     """
     Validate and Auto-Crop user photo for Try-On.
     """
     try:
-        content = await file.read()
-        result = ai_service.validate_and_crop_user_photo(content)
+        content = await read_upload(file)
+        result = await ai_service.validate_and_crop_user_photo(content)
         
         if not result["valid"]:
-             return JSONResponse(status_code=400, content={"message": result["reason"]})
+             return ORJSONResponse(status_code=400, content={"message": result["reason"]})
         
         # If valid, return the processed image
         # We need to return the bytes.
         # But FastAPI return usually file or json.
         # Let's return the file directly.
         if result["processed_image"]:
-             return Response(content=result["processed_image"], media_type="image/jpeg")
+             return image_response(result["processed_image"], "image/jpeg")
         else:
              # Should not happen if valid image returned
-             return Response(content=content, media_type="image/jpeg")
+             return image_response(content, "image/jpeg")
              
+    except HTTPException as he:
+        raise he
     except Exception as e:
         print(f"Validate error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/api/try-on")
+@app.post("/api/try-on", dependencies=NEEDS_BOTH)
 async def try_on(
+    request: Request,
     file: UploadFile = File(...), # User's photo
     clothes_id: str = Form(...)
 ):
     """
     Virtual Try-On Endpoint.
+    Returns WebP when the client's Accept header allows it, JPEG otherwise.
     """
     try:
         # Get clothes info first
@@ -363,52 +795,38 @@ async def try_on(
         if not cloth_info:
              raise HTTPException(status_code=404, detail="Clothes not found in DB")
 
-        # Determine Cloth Image Path
-        # Priority: 1. Download from Image URL (New Data) 2. Existing Local File (Legacy Data)
+        # Determine Cloth Image Path from the DB row (the source of truth)
+        # Priority: 1. Download from Image URL (New Data) 2. Local file named by image_url (Legacy Data)
         # This prevents ID collisions where local '002' overrides cloud '002'
-        local_path = os.path.join(MODEL_DIR, f"{clothes_id}.jpg")
-        temp_cloth_path = None
+        image_url = cloth_info.get('image_url', '')
+        if image_url.startswith('http'):
+            local_path = os.path.join(MODEL_DIR, f"{clothes_id}.jpg")
+        else:
+            # "/images/<file>" (see ClothesManager) maps to MODEL_DIR/<file>
+            local_path = os.path.join(MODEL_DIR, os.path.basename(image_url) or f"{clothes_id}.jpg")
         final_cloth_path = None
 
-        if cloth_info.get('image_url', '').startswith('http'):
-            # Download from Cloudinary/URL
-            try:
-                import requests
-                import tempfile
-                print(f"Downloading cloth image from {cloth_info['image_url']}...")
-                response = requests.get(cloth_info['image_url'])
-                if response.status_code == 200:
-                    # Create temp file
-                    fd, temp_cloth_path = tempfile.mkstemp(suffix=".jpg")
-                    os.close(fd)
-                    with open(temp_cloth_path, "wb") as f:
-                        f.write(response.content)
-                    final_cloth_path = temp_cloth_path
-                    print(f"Downloaded to temp: {final_cloth_path}")
-                else:
-                    print(f"Failed to download image: {response.status_code}")
-                    # Fallback to local if download fails
-                    if os.path.exists(local_path):
-                        final_cloth_path = local_path
-            except Exception as e:
-                 print(f"Download error: {e}")
-                 # Fallback to local
-                 if os.path.exists(local_path):
-                    final_cloth_path = local_path
-        
-        elif os.path.exists(local_path):
+        if image_url.startswith('http'):
+            # Download from Cloudinary/URL while the user's photo is read
+            cloth_path, user_image = await asyncio.gather(fetch_cloth_image(image_url), read_upload(file))
+            # Fallback to local if download fails
+            final_cloth_path = cloth_path or (local_path if os.path.exists(local_path) else None)
+        else:
              final_cloth_path = local_path
+             user_image = None
 
-        
+        # Single existence check for whichever source was picked
         if not final_cloth_path or not os.path.exists(final_cloth_path):
              raise HTTPException(status_code=404, detail="Clothing image file not found locally or remotely.")
 
-        user_image = await file.read()
+        if user_image is None:
+            user_image = await read_upload(file)
         
         cloth_name = cloth_info.get('name', 'Upper-body')
         category = cloth_info.get('category', 'Upper-body')
         try_on_method = cloth_info.get('try_on_method', 'auto')
         height_ratio = cloth_info.get('height_ratio', None)
+        output_format = "WEBP" if "image/webp" in request.headers.get("accept", "") else "JPEG"
         
         # Verify Replicate Token Status
         replicate_status = "Available" if os.environ.get("REPLICATE_API_TOKEN") else "Missing"
@@ -416,37 +834,33 @@ async def try_on(
         print(f"Inputs: User({len(user_image)} bytes), Cloth({final_cloth_path})")
 
         # Call AI VTON Service
-        try:
-            print("Calling ai_service.virtual_try_on...")
-            result_image = ai_service.virtual_try_on(
-                user_image, 
-                final_cloth_path, 
-                cloth_name=cloth_name, 
-                category=category,
-                method=try_on_method,
-                height_ratio=height_ratio
-            )
-            print("AI Service returned successfully.")
-        finally:
-            # Cleanup temp file
-            if temp_cloth_path and os.path.exists(temp_cloth_path):
-                try:
-                    os.remove(temp_cloth_path)
-                    print(f"Cleaned up temp cloth: {temp_cloth_path}")
-                except:
-                    pass
+        # (the downloaded garment stays in CLOTH_DOWNLOAD_DIR for the next try-on)
+        print("Calling ai_service.virtual_try_on_async...")
+        # Inference takes 20-60s; the async pipeline keeps the event loop serving other requests meanwhile
+        result_image = await ai_service.virtual_try_on_async(
+            user_image, 
+            final_cloth_path, 
+            cloth_name=cloth_name, 
+            category=category,
+            method=try_on_method,
+            height_ratio=height_ratio,
+            output_format=output_format
+        )
+        print("AI Service returned successfully.")
         
-        return Response(content=result_image, media_type="image/jpeg")
-
-        return Response(content=result_image, media_type="image/jpeg")
+        # The result is always encoded in output_format (the watermark fallback re-encodes too)
+        media_type = "image/webp" if output_format == "WEBP" else "image/jpeg"
+        return image_response(result_image, media_type, headers={"Vary": "Accept"})
 
+    except HTTPException as he:
+        raise he
     except Exception as e:
         print(f"Try-on error: {e}")
         import traceback
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"Try-on Error: {str(e)}")
 
-@app.delete("/api/clothes/{cloth_id}")
+@app.delete("/api/clothes/{cloth_id}", dependencies=NEEDS_CLOTHES)
 async def delete_clothing(cloth_id: str):
     """
     Delete a clothing item and its image.
@@ -457,44 +871,38 @@ async def delete_clothing(cloth_id: str):
         if not item:
             raise HTTPException(status_code=404, detail="Item not found")
             
-        # Delete from DB
-        success = clothes_manager.delete_clothing_item(cloth_id)
-        if not success:
-             raise HTTPException(status_code=500, detail="Failed to delete from DB")
-
-        # Delete Image
-        image_url = item.get('image_url', '')
+        # The DB row goes first: if that fails the images must stay, or the row would
+        # list a deleted image. The Cloudinary image and local file are then deleted concurrently.
         
         # 1. Cloudinary Delete
-        if "cloudinary" in image_url and os.getenv("CLOUDINARY_URL"):
-            try:
-                import cloudinary.uploader
-                # Extract public_id
-                # URL: https://res.cloudinary.com/cloudname/image/upload/v12345/folder/id.jpg
-                # We need header/id (without extension usually)
-                parts = image_url.split('/')
-                filename = parts[-1]
-                public_id_name = filename.split('.')[0]
-                
-                # Check for folder (assuming 1 level folder "clothing_app")
-                # If we used folder="clothing_app" in upload
-                folder = "clothing_app"
-                public_id = f"{folder}/{public_id_name}"
-                
-                print(f"Deleting from Cloudinary: {public_id}")
-                cloudinary.uploader.destroy(public_id)
-            except Exception as e:
-                print(f"Cloudinary delete failed: {e}")
+        public_id = item.get('public_id')
+        def delete_cloud_image():
+            print(f"Deleting from Cloudinary: {public_id}")
+            cloudinary.uploader.destroy(public_id)
         
         # 2. Local File Delete
-        # Even if using Cloudinary, we might have local temp files or old files
-        local_filename = f"{cloth_id}.jpg" # Simplified assumption
+        # Even if using Cloudinary, we might have local temp files or old files.
+        # Local images are "/images/<file>" (e.g. temp_<ts>.jpg from the upload fallback)
+        image_url = item.get('image_url', '')
+        local_filename = image_url.rpartition('/')[2] if image_url.startswith('/images/') else f"{cloth_id}.jpg"
         local_path = os.path.join(MODEL_DIR, local_filename)
-        if os.path.exists(local_path):
-             try:
-                 os.remove(local_path)
-             except Exception as e:
-                 print(f"Local file delete failed: {e}")
+        def delete_local_file():
+            try:
+                os.remove(local_path)
+            except FileNotFoundError:
+                pass
+
+        success = await asyncio.to_thread(clothes_manager.delete_clothing_item, cloth_id)
+        if not success:
+             raise HTTPException(status_code=500, detail="Failed to delete from DB")
+
+        tasks = [asyncio.to_thread(delete_local_file)]
+        if public_id and CLOUDINARY_ENABLED:
+            tasks.append(asyncio.to_thread(delete_cloud_image))
+        # Image cleanup failures are logged; the item itself is already deleted
+        for error in await asyncio.gather(*tasks, return_exceptions=True):
+            if isinstance(error, Exception):
+                print(f"Image delete failed: {error}")
 
         return {"status": "deleted", "id": cloth_id}
     except HTTPException as he:
@@ -510,7 +918,7 @@ class UpdateClothRequest(BaseModel):
     height_range: Optional[str] = None
     category: Optional[str] = None
 
-@app.put("/api/clothes/{cloth_id}")
+@app.put("/api/clothes/{cloth_id}", dependencies=NEEDS_CLOTHES)
 async def update_clothing(cloth_id: str, updates: UpdateClothRequest):
     """
     Update clothing metadata.
@@ -522,7 +930,7 @@ async def update_clothing(cloth_id: str, updates: UpdateClothRequest):
         if not update_data:
              return {"status": "no_changes"}
 
-        success = clothes_manager.update_clothing_item(cloth_id, update_data)
+        success = await asyncio.to_thread(clothes_manager.update_clothing_item, cloth_id, update_data)
         if not success:
             raise HTTPException(status_code=404, detail="Item not found or update failed")
             
@@ -531,7 +939,7 @@ async def update_clothing(cloth_id: str, updates: UpdateClothRequest):
         print(f"Update error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.get("/api/recommend-outfit")
+@app.get("/api/recommend-outfit", dependencies=NEEDS_BOTH)
 async def recommend_outfit(
     height: str,
     weight: str,
@@ -541,23 +949,12 @@ async def recommend_outfit(
     """
     根據使用者的身高、體重、性別和風格偏好推薦服裝組合。
     """
-    if not clothes_manager:
-        raise HTTPException(status_code=500, detail="ClothesManager failed to initialize")
-    
-    if not ai_service:
-        raise HTTPException(status_code=500, detail="AIService failed to initialize")
-    
     try:
         # 獲取所有可用服裝
         all_clothes = clothes_manager.get_all_clothes()
         
-        # 添加圖片 URL（如果缺失）
-        for c in all_clothes:
-            if 'image_url' not in c or not c['image_url']:
-                c['image_url'] = f"/images/{c['id']}.jpg"
-        
         # 使用 AI 服務推薦服裝組合
-        recommended_outfits = ai_service.recommend_outfit(
+        recommended_outfits = await ai_service.recommend_outfit(
             height=height,
             weight=weight,
             gender=gender,
@@ -577,5 +974,15 @@ async def recommend_outfit(
         raise HTTPException(status_code=500, detail=str(e))
 
 if __name__ == "__main__":
+    import sys
+    import importlib.util
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # uvloop/httptools: faster event loop and HTTP parser (POSIX only, used when installed)
+    fast_loop = sys.platform != "win32" and importlib.util.find_spec("uvloop") is not None
+    fast_http = importlib.util.find_spec("httptools") is not None
+    # Single process by default (the list cache and AI pools are per process);
+    # set WEB_CONCURRENCY to opt into more, JSON writes are serialized with a file lock
+    workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+    uvicorn.run("backend.main:app" if workers > 1 else app, host="0.0.0.0", port=8000,
+                loop="uvloop" if fast_loop else "auto", http="httptools" if fast_http else "auto",
+                workers=workers)
@@ -1,11 +1,15 @@
 from backend.clothes_manager import ClothesManager
 from backend.ai_service import AIService
+from _images import index_images
 import os
+import asyncio
 
 # Setup
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DATA_FILE = os.path.join(BASE_DIR, "model", "衣服介紹.txt")
 MODEL_DIR = os.path.join(BASE_DIR, "model")
+# Per-item Gemini calls in flight at once (fallback for items the batch job missed)
+CONCURRENCY = 12
 
 manager = ClothesManager(DATA_FILE)
 ai_service = AIService()
@@ -13,40 +17,61 @@ ai_service = AIService()
 def process():
     print(f"Reading from {DATA_FILE}")
     clothes = manager.get_all_clothes()
+    images = index_images(MODEL_DIR)
     updated_count = 0
     
-    for item in clothes:
-        # Check if needs update (Legacy format usually has "未知衣物" or missing style)
-        if item.get("name") == "未知衣物" or item.get("style") == "未分類":
-            print(f"Updating item {item['id']}...")
+    # Items that need an update (Legacy format usually has "未知衣物" or missing style)
+    candidates = sorted((c for c in clothes if c.get("name") == "未知衣物" or c.get("style") == "未分類"),
+                        key=lambda c: str(c["id"]))
+    print(f"{len(candidates)}/{len(clothes)} items need an update")
+    if not candidates:
+        print("No items needed updating.")
+        return
+    
+    # Collect them with their image bytes
+    pending = []
+    for item in candidates:
+        print(f"Updating item {item['id']}...")
+        
+        # Find image (jpg or png, from one directory scan)
+        image_path = images.get(str(item['id']))
+        
+        try:
+            if image_path is None:
+                raise FileNotFoundError(item['id'])
+            with open(image_path, "rb") as f:
+                pending.append((item, f.read()))
+        except FileNotFoundError:
+            # Not indexed, or removed since the scan (no exists() check before the open)
+            print(f"Image not found for {item['id']}")
+
+    # Not interactive: use Gemini Batch Mode (half price), per-item calls for whatever it misses
+    batch_results = ai_service.analyze_image_style_batch([(item["id"], content) for item, content in pending])
+
+    # One event loop for all fallbacks: cached Gemini clients are bound to the loop they first ran on
+    async def analyze_missing():
+        missing = [(item, content) for item, content in pending if str(item["id"]) not in batch_results]
+        sem = asyncio.Semaphore(CONCURRENCY)
+        async def analyze(content):
+            async with sem:
+                return await ai_service.analyze_image_style(content)
+        results = await asyncio.gather(*(analyze(content) for _, content in missing))
+        return {str(item["id"]): result for (item, _), result in zip(missing, results)}
+    if len(batch_results) < len(pending):
+        batch_results.update(asyncio.run(analyze_missing()))
+
+    for item, content in pending:
+        try:
+            analysis = batch_results[str(item["id"])]
             
-            # Find image
-            # Try jpg or png
-            image_path = os.path.join(MODEL_DIR, f"{item['id']}.jpg")
-            if not os.path.exists(image_path):
-                image_path = os.path.join(MODEL_DIR, f"{item['id']}.png")
+            # Update item
+            # Mimicking "AI" by adding ID to name to distinguish them
+            item["name"] = f"AI精選_{analysis['name']}_{item['id']}"
+            item["style"] = analysis['style']
             
-            if os.path.exists(image_path):
-                try:
-                    with open(image_path, "rb") as f:
-                        content = f.read()
-                    
-                    # Call AI (Mock)
-                    # To make it look realistic, let's vary the mock response slightly based on ID if using mock
-                    # But ai_service.analyze_image_style is likely static.
-                    # Let's just use what it returns.
-                    analysis = ai_service.analyze_image_style(content)
-                    
-                    # Update item
-                    # Mimicking "AI" by adding ID to name to distinguish them
-                    item["name"] = f"AI精選_{analysis['name']}_{item['id']}"
-                    item["style"] = analysis['style']
-                    
-                    updated_count += 1
-                except Exception as e:
-                    print(f"Failed to process image for {item['id']}: {e}")
-            else:
-                print(f"Image not found for {item['id']}")
+            updated_count += 1
+        except Exception as e:
+            print(f"Failed to process image for {item['id']}: {e}")
 
     if updated_count > 0:
         manager.save_all_clothes(clothes)
@@ -1,9 +1,18 @@
 from gradio_client import Client
 
+# Connected clients per space: Client() fetches the Space config over the network
+_CLIENTS = {}
+
+def get_client(space_name):
+    client = _CLIENTS.get(space_name)
+    if client is None:
+        client = _CLIENTS[space_name] = Client(space_name)
+    return client
+
 def check_api(space_name):
     print(f"--- Checking parameters for {space_name} ---")
     try:
-        client = Client(space_name)
+        client = get_client(space_name)
         client.view_api()
     except Exception as e:
         print(f"Error connecting to {space_name}: {e}")
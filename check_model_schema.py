@@ -1,8 +1,9 @@
 import os
 import replicate
-from dotenv import load_dotenv
+from _env import load
+from replicate_schema import get_schema
 
-load_dotenv(".env")
+load()
 
 api_token = os.getenv("REPLICATE_API_TOKEN")
 if not api_token:
@@ -16,12 +17,11 @@ model_id = "cuuupid/idm-vton"
 version_id = "0513734a452173b8173e907e3a59d19a36266e55b48528559432bd21c7d7e985"
 
 try:
-    model = client.models.get(model_id)
-    version = model.versions.get(version_id)
+    _, openapi_schema = get_schema(client, model_id, version_id)
     
     print(f"--- Schema for {model_id}:{version_id} ---")
     print("Input Schema:")
-    for key, prop in version.openapi_schema['components']['schemas']['Input']['properties'].items():
+    for key, prop in openapi_schema['components']['schemas']['Input']['properties'].items():
         print(f" - {key}: {prop.get('description', 'No description')}")
         if 'enum' in prop:
             print(f"   Enum: {prop['enum']}")
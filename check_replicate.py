@@ -1,13 +1,17 @@
 import replicate
 import os
-from dotenv import load_dotenv
+from concurrent.futures import ThreadPoolExecutor
+from _env import load
 
-load_dotenv()
+load()
+
+# One client for every lookup: keep-alive connections to the API are shared across checks
+_CLIENT = replicate.Client(api_token=os.getenv("REPLICATE_API_TOKEN"))
 
 def check_model(model_name):
     print(f"Checking {model_name}...")
     try:
-        model = replicate.models.get(model_name)
+        model = _CLIENT.models.get(model_name)
         print(f"Model found: {model.owner}/{model.name}")
         if model.latest_version:
             print(f"Latest version: {model.latest_version.id}")
@@ -26,11 +30,9 @@ candidates = [
     "fashn/tryon"
 ]
 
-valid_models = []
-for c in candidates:
-    ver = check_model(c)
-    if ver:
-        valid_models.append(ver)
+# Independent lookups: run them in parallel (results stay in candidate order)
+with ThreadPoolExecutor(max_workers=8) as ex:
+    valid_models = [ver for ver in ex.map(check_model, candidates) if ver]
 
 print("\nValid Models Found:")
 for m in valid_models:
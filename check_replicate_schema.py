@@ -1,35 +1,26 @@
 import os
 import replicate
-from dotenv import load_dotenv
+from _env import load
+from replicate_schema import get_schema
 import json
 
-load_dotenv(".env")
+load()
 token = os.getenv("REPLICATE_API_TOKEN")
 if not token:
     print("❌ Token NOT found in env.")
-    # Try reading manually
-    try:
-        with open(".env", "r") as f:
-            for line in f:
-                if line.startswith("REPLICATE_API_TOKEN="):
-                    os.environ["REPLICATE_API_TOKEN"] = line.split("=", 1)[1].strip()
-                    print("✅ Token manually loaded from .env")
-    except:
-        pass
 else:
     print("✅ Token found in env.")
 
 try:
     print("Checking Replicate Model Schema...")
     model_name = "cuuupid/idm-vton"
-    model = replicate.models.get(model_name)
-    version = model.latest_version
+    version_id, openapi_schema = get_schema(replicate, model_name)
     
     print(f"Model: {model_name}")
-    print(f"Version ID: {version.id}")
+    print(f"Version ID: {version_id}")
     
     # Print Schema
-    schema = version.openapi_schema.get("components", {}).get("schemas", {}).get("Input", {})
+    schema = openapi_schema.get("components", {}).get("schemas", {}).get("Input", {})
     print("\n--- Input Schema ---")
     properties = schema.get("properties", {})
     for key, val in properties.items():
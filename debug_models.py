@@ -1,8 +1,8 @@
 import os
-from dotenv import load_dotenv
+from _env import load
 import google.generativeai as genai
 
-load_dotenv()
+load()
 
 api_key = os.getenv("GEMINI_API_KEY")
 if not api_key:
@@ -1,17 +1,60 @@
-import google.generativeai as genai
 import os
-from dotenv import load_dotenv
+import argparse
+from _env import load
 
-load_dotenv(os.path.join(os.path.dirname(__file__), '.env'))
+load()
 keys_str = os.getenv("GEMINI_API_KEY", "")
 keys = [k.strip() for k in keys_str.split(',') if k.strip()]
 
-genai.configure(api_key=keys[0])
+# Heavy SDK imports happen inside the command that needs them
 
-print("Listing models to find 2.5/3...")
-try:
-    for m in genai.list_models():
-         if 'gemini' in m.name:
-             print(f"Model: {m.name}")
-except Exception as e:
-    print(f"Error listing: {e}")
+def list_models():
+    import google.generativeai as genai
+    genai.configure(api_key=keys[0])
+
+    print("Listing models to find 2.5/3...")
+    try:
+        for m in genai.list_models():
+             if 'gemini' in m.name:
+                 print(f"Model: {m.name}")
+    except Exception as e:
+        print(f"Error listing: {e}")
+
+def test_keys():
+    import google.generativeai as genai
+    for i, key in enumerate(keys):
+        genai.configure(api_key=key)
+        try:
+            next(iter(genai.list_models()))
+            print(f"Key {i + 1} (...{key[-4:]}): OK")
+        except Exception as e:
+            print(f"Key {i + 1} (...{key[-4:]}): FAIL {e}")
+
+def validate_image(path):
+    import asyncio
+    from backend.ai_service import AIService
+    with open(path, "rb") as f:
+        content = f.read()
+    result = asyncio.run(AIService().validate_and_crop_user_photo(content))
+    print(f"Valid: {result['valid']}")
+    print(f"Reason: {result['reason']}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Gemini validation debugging (lists models by default)")
+    parser.add_argument("--list-models", action="store_true", help="list available Gemini models")
+    parser.add_argument("--test-keys", action="store_true", help="check every key in GEMINI_API_KEY")
+    parser.add_argument("--validate-image", metavar="PATH", help="run the avatar validation on a photo")
+    args = parser.parse_args()
+
+    if not keys:
+        print("Error: GEMINI_API_KEY not found.")
+        return
+    if args.test_keys:
+        test_keys()
+    if args.validate_image:
+        validate_image(args.validate_image)
+    if args.list_models or not (args.test_keys or args.validate_image):
+        list_models()
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,9 @@
 import os
 import replicate
-from dotenv import load_dotenv
+from _env import load
+from replicate_schema import get_schema
 
-load_dotenv()
+load()
 token = os.getenv("REPLICATE_API_TOKEN")
 print(f"Token present: {bool(token)}")
 
@@ -13,13 +14,13 @@ if not token:
 try:
     client = replicate.Client(api_token=token)
     print("Fetching model cuuupid/idm-vton...")
-    model = client.models.get("cuuupid/idm-vton")
+    latest = get_schema(client, "cuuupid/idm-vton")
     
-    if model.latest_version:
-        print(f"Latest Version ID: {model.latest_version.id}")
+    if latest:
+        print(f"Latest Version ID: {latest[0]}")
     else:
         print("Model found but no latest version (Result is None). Listing versions...")
-        versions = model.versions.list()
+        versions = client.models.get("cuuupid/idm-vton").versions.list()
         if versions:
             print(f"Most recent version: {versions[0].id}")
         else:
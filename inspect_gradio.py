@@ -1,22 +1,39 @@
 from gradio_client import Client
-import sys
+from concurrent.futures import ThreadPoolExecutor
+import argparse
 
 spaces = [
     "KWai-Kolors/Kolors-Virtual-Try-On",
     "levihsu/OOTDiffusion"
 ]
 
-with open("gradio_api_info.txt", "w", encoding="utf-8") as f:
-    for space in spaces:
-        f.write(f"\n--- Checking {space} ---\n")
-        try:
-            client = Client(space)
-            # Redirect stdout to file to capture view_api
-            original_stdout = sys.stdout
-            sys.stdout = f
-            client.view_api()
-            sys.stdout = original_stdout
-            f.write(f"\n--- SUCCESS: {space} ---\n")
-        except Exception as e:
-            sys.stdout = sys.__stdout__ # Restore just in case
-            f.write(f"Error checking {space}: {e}\n")
+def inspect_space(space):
+    """
+    view_api() text for one space, as a string: each probe builds its own report,
+    so the spaces can be checked in parallel without sharing sys.stdout.
+    """
+    report = f"\n--- Checking {space} ---\n"
+    try:
+        # verbose=False: Client() would otherwise print "Loaded as API" from every probe thread
+        client = Client(space, verbose=False)
+        report += client.view_api(print_info=False, return_format="str")
+        report += f"\n--- SUCCESS: {space} ---\n"
+    except Exception as e:
+        report += f"Error checking {space}: {e}\n"
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description="Dump the API of Gradio Spaces")
+    parser.add_argument("--spaces", nargs="+", default=spaces, help="Spaces to inspect")
+    parser.add_argument("--out", default="gradio_api_info.txt", help="output file")
+    args = parser.parse_args()
+
+    # Independent network probes: total time is the slowest space, not the sum
+    with ThreadPoolExecutor(max_workers=8) as ex:
+        reports = list(ex.map(inspect_space, args.spaces))
+
+    with open(args.out, "w", encoding="utf-8") as f:
+        f.writelines(reports)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,33 @@
+import os
+import json
+import time
+
+# Version schemas fetched from Replicate, reused for a day (they rarely change between runs)
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "replicate")
+CACHE_TTL = 24 * 3600
+
+def get_schema(client, model_id, version_id=None):
+    """
+    (version_id, openapi_schema) of `model_id` at `version_id` (latest when None), or None
+    when the model has no latest version. `client` is a replicate.Client or the replicate module.
+    Served from CACHE_DIR when a cached copy is less than CACHE_TTL old.
+    """
+    cache_path = os.path.join(CACHE_DIR, f"{model_id.replace('/', '_')}_{version_id or 'latest'}.json")
+    try:
+        if time.time() - os.path.getmtime(cache_path) < CACHE_TTL:
+            with open(cache_path, "r", encoding="utf-8") as f:
+                cached = json.load(f)
+            print(f"(schema from cache: {cache_path})")
+            return cached["id"], cached["openapi_schema"]
+    except (OSError, ValueError, KeyError):
+        pass
+
+    model = client.models.get(model_id)
+    version = model.versions.get(version_id) if version_id else model.latest_version
+    if version is None:
+        return None
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(cache_path, "w", encoding="utf-8") as f:
+        json.dump({"id": version.id, "openapi_schema": version.openapi_schema}, f)
+    return version.id, version.openapi_schema
@@ -1,18 +1,19 @@
 import requests
-import os
 
 from PIL import Image
 import io
 
-# Create a valid dummy image (Cloudinary validates headers)
+# Create a valid dummy image (Cloudinary validates headers), encoded in memory
 dummy_filename = "test_upload.jpg"
 img = Image.new('RGB', (100, 100), color = 'red')
-img.save(dummy_filename)
+buf = io.BytesIO()
+img.save(buf, format='JPEG')
+buf.seek(0)
 
 url = "http://localhost:8000/api/upload"
 
 files = {
-    'file': (dummy_filename, open(dummy_filename, 'rb'), 'image/jpeg')
+    'file': (dummy_filename, buf, 'image/jpeg')
 }
 data = {
     'height_range': '160-170',
@@ -53,9 +54,3 @@ except ImportError as e:
     print(f"❌ Dependencies missing or path issue: {e}")
 except Exception as e:
     print(f"❌ Error: {e}")
-
-# Cleanup
-try:
-    os.remove(dummy_filename)
-except:
-    pass
@@ -1,10 +1,10 @@
 import os
-import io
+import tempfile
 from PIL import Image
 from backend.ai_service import AIService
-from dotenv import load_dotenv
+from _env import load
 
-load_dotenv()
+load()
 
 def create_dummy_pants_image():
     # Create a WIDE blue rectangle image representing folded jeans (to trigger aspect ratio fix)
@@ -13,9 +13,10 @@ def create_dummy_pants_image():
     from PIL import ImageDraw
     draw = ImageDraw.Draw(img)
     draw.rectangle([100, 100, 700, 500], fill=(50, 100, 200)) 
-    path = "dummy_pants_wide.jpg"
-    img.save(path)
-    return path
+    # virtual_try_on takes a path: write it to the temp dir, not the repo root
+    with tempfile.NamedTemporaryFile(suffix=".jpg", delete=False) as f:
+        img.save(f, format="JPEG")
+    return f.name
 
 def main():
     print("Initializing AIService...")
@@ -24,13 +25,13 @@ def main():
     # Path to user image (from artifacts)
     user_img_path = r"C:\Users\liskyo\.gemini\antigravity\brain\bf0bec16-d2b5-41cc-bd94-8076de1e9832\uploaded_image_1768135372242.png"
     
-    if not os.path.exists(user_img_path):
+    print(f"Reading user image from {user_img_path}...")
+    try:
+        with open(user_img_path, "rb") as f:
+            person_bytes = f.read()
+    except FileNotFoundError:
         print(f"User image not found at {user_img_path}")
         return
-
-    print(f"Reading user image from {user_img_path}...")
-    with open(user_img_path, "rb") as f:
-        person_bytes = f.read()
         
     cloth_path = create_dummy_pants_image()
     print(f"Created dummy pants at {cloth_path}")
@@ -58,6 +59,8 @@ def main():
         print(f"CRITICAL ERROR: {e}")
         import traceback
         traceback.print_exc()
+    finally:
+        os.unlink(cloth_path)
 
 if __name__ == "__main__":
     main()
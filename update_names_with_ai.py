@@ -2,12 +2,15 @@ import os
 import asyncio
 from backend.clothes_manager import ClothesManager
 from backend.ai_service import AIService
+from _images import index_images
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 MODEL_DIR = os.path.join(BASE_DIR, "model")
 DATA_FILE = os.path.join(MODEL_DIR, "clothes.json")
-
-import time
+# Items analyzed at once
+CONCURRENCY = 12
+# Save progress after this many updates, so a crash mid-run loses at most that many
+CHECKPOINT_EVERY = 25
 
 async def update_names():
     print("Initialize Managers...")
@@ -16,28 +19,35 @@ async def update_names():
     
     clothes = manager.get_all_clothes()
     print(f"Found {len(clothes)} items to process.")
+    images = index_images(MODEL_DIR)
     
     updated_count = 0
+    # Gemini round trips dominate: keep several in flight (rate limits still apply per key)
+    sem = asyncio.Semaphore(CONCURRENCY)
     
-    for item in clothes:
-        print(f"Processing {item['id']}...")
-        
-        # Try to find image
-        image_path = os.path.join(MODEL_DIR, f"{item['id']}.jpg")
-        if not os.path.exists(image_path):
-            image_path = os.path.join(MODEL_DIR, f"{item['id']}.png")
+    async def handle(item):
+        nonlocal updated_count
+        async with sem:
+            print(f"Processing {item['id']}...")
             
-        if os.path.exists(image_path):
-            content = None
-            with open(image_path, "rb") as f:
-                content = f.read()
+            # Find image (one directory scan instead of stat() per candidate)
+            image_path = images.get(str(item['id']))
+            try:
+                if image_path is None:
+                    raise FileNotFoundError(item['id'])
+                with open(image_path, "rb") as f:
+                    content = f.read()
+            except FileNotFoundError:
+                # Not indexed, or removed since the scan (no exists() check before the open)
+                print(f"  - Image not found for {item['id']}")
+                return
             
             # Retry loop
             max_retries = 3
             for attempt in range(max_retries):
                 try:
-                    print(f"  - Analyzing image with Gemini (Attempt {attempt+1})...")
-                    analysis = ai_service.analyze_image_style(content)
+                    print(f"  - [{item['id']}] Analyzing image with Gemini (Attempt {attempt+1})...")
+                    analysis = await ai_service.analyze_image_style(content)
                     
                     new_name = analysis.get("name")
                     new_style = analysis.get("style")
@@ -49,21 +59,23 @@ async def update_names():
                         item['name'] = new_name
                         item['style'] = new_style
                         updated_count += 1
+                        if updated_count % CHECKPOINT_EVERY == 0:
+                            # Synchronous on purpose: no other handle() runs mid-save (atomic file replace)
+                            print(f"Checkpoint: saving {updated_count} updates...")
+                            manager.save_all_clothes(clothes)
                         break # Success
                     else:
                         print(f"  - Got mock response: {new_name}")
                         # If it's a mock response due to error inside ai_service, it prints the error there.
                         # We can't easily detect 429 here unless we modify ai_service to raise.
-                        # But let's assume if we get mock, we might want to wait and retry if it was rate limit?
-                        # Actually ai_service swallows exception.
-                        # For batch script, maybe we should just accept it or wait a bit.
-                        time.sleep(2) 
+                        # For batch script, wait a bit (without stalling the other items) and retry.
+                        await asyncio.sleep(2)
                         
                 except Exception as e:
                     print(f"  - Error in script: {e}")
-                    time.sleep(5)
-        else:
-            print(f"  - Image not found for {item['id']}")
+                    await asyncio.sleep(5)
+
+    await asyncio.gather(*(handle(item) for item in clothes))
 
     if updated_count > 0:
         print(f"Saving {updated_count} updates to {DATA_FILE}...")
@@ -73,4 +85,11 @@ async def update_names():
         print("No updates made.")
 
 if __name__ == "__main__":
-    asyncio.run(update_names())
+    # uvloop: cheaper task wake-ups with many Gemini calls in flight (POSIX only, used when installed)
+    try:
+        import uvloop
+        loop_factory = uvloop.new_event_loop
+    except ImportError:
+        loop_factory = None
+    with asyncio.Runner(loop_factory=loop_factory) as runner:
+        runner.run(update_names())